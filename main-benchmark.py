@@ -0,0 +1,119 @@
+"""
+Benchmarks, run on the library in ./data: throughput of the inference backends (needs tensorflow and the model), and
+size and serialization time of the API's playtree payloads (needs neither). Pass the names of the benchmarks to run,
+e.g. python main-benchmark.py payload - all of them by default.
+"""
+
+import os
+import sys
+import time
+
+from resonant import config
+
+# songs from the library to benchmark on, and how many times to run each configuration over them
+NUM_SONGS = 8
+NUM_REPEATS = 2
+CPU_COUNT = os.cpu_count()
+
+
+# inference
+
+def inference_throughput(backend, patch_sets, num_cores):
+    """
+    Return songs per second per core for running the backend over the passed (per-song) patch sets.
+    """
+    # warm up - the first call loads the model and lets grappler optimize the graph
+    backend.predict(patch_sets[0][:backend.batch_size])
+    start = time.perf_counter()
+    for _ in range(NUM_REPEATS):
+        for patches in patch_sets:
+            for i in range(0, patches.shape[0], backend.batch_size):
+                backend.predict(patches[i:i + backend.batch_size])
+    elapsed = time.perf_counter() - start
+    return NUM_REPEATS * len(patch_sets) / elapsed / num_cores
+
+
+def inference_benchmark():
+    from songaffect import TensorflowBackend
+    from songaffect.affect_vector_extraction import _audio_to_mel_patches, model_path
+    from songaffect.inference import compare_backends
+
+    music_files = sorted(os.listdir(config.music_dir))[:NUM_SONGS]
+    print(f"Computing mel patches for {len(music_files)} songs")
+    patch_sets = [_audio_to_mel_patches(os.path.join(config.music_dir, filename)) for filename in music_files]
+
+    reference = TensorflowBackend(model_path(), optimize_graph=False)
+
+    configurations = {
+        "default graph, all threads": (reference, CPU_COUNT),
+        "optimized graph, all threads": (TensorflowBackend(model_path()), CPU_COUNT),
+        "optimized graph, 1 thread": (TensorflowBackend(model_path(), intra_op_threads=1, inter_op_threads=1), 1),
+        "optimized graph, 4 threads": (TensorflowBackend(model_path(), intra_op_threads=4, inter_op_threads=1), 4),
+        "reduced precision, all threads": (TensorflowBackend(model_path(), reduced_precision=True), CPU_COUNT),
+    }
+
+    print("\nInference throughput (songs/s/core)")
+    for name, (backend, num_cores) in configurations.items():
+        print(f"{inference_throughput(backend, patch_sets, num_cores):10.3f}  {name}")
+
+    print("\nAgreement with reference vectors (min cosine similarity over songs)")
+    for name, (backend, _) in configurations.items():
+        if backend is reference: continue
+        print(f"{min(compare_backends(reference, backend, patch_sets)):10.6f}  {name}")
+
+    for backend, _ in configurations.values():
+        backend.close()
+
+
+# api payloads - size and serialization time of playtree responses, per encoding
+
+NUM_PAYLOAD_QUERIES = 32
+PAYLOAD_NUM_SONGS = 8
+
+
+def payload_benchmark():
+    import gzip
+    import json
+    from fastapi.encoders import jsonable_encoder
+    from backend.api import _compute_playlist_response, _encode_result
+    from backend.serialization import dumps, orjson, GZIP_LEVEL
+    from backend.state import song_repository
+
+    songs = song_repository.get_all_songs()[:NUM_PAYLOAD_QUERIES]
+    results = [_compute_playlist_response((song.raw_name,), PAYLOAD_NUM_SONGS, True) for song in songs]
+    serializers = {
+        "fastapi default": lambda obj: json.dumps(jsonable_encoder(obj)).encode(),
+        "orjson" if orjson is not None else "json, compact separators": dumps,
+    }
+
+    print(f"\nPlaytree payloads ({len(results)} playtrees of {PAYLOAD_NUM_SONGS} songs, mean per response)")
+    print(f"{'bytes':>10}{'gzipped':>10}{'encode ms':>11}{'gzip ms':>9}  encoding")
+    for compact in (False, True):
+        payloads = [_encode_result(result, True, compact) for result in results]
+        for serializer_name, serialize in serializers.items():
+            start = time.perf_counter()
+            bodies = [serialize(payload) for payload in payloads]
+            encode_time = time.perf_counter() - start
+            start = time.perf_counter()
+            gzipped = [gzip.compress(body, compresslevel=GZIP_LEVEL) for body in bodies]
+            gzip_time = time.perf_counter() - start
+            n = len(bodies)
+            print(f"{sum(map(len, bodies)) / n:10.0f}{sum(map(len, gzipped)) / n:10.0f}"
+                  f"{1000 * encode_time / n:11.3f}{1000 * gzip_time / n:9.3f}  "
+                  f"{'compact' if compact else 'verbose'}, {serializer_name}")
+
+
+BENCHMARKS = {
+    "inference": inference_benchmark,
+    "payload": payload_benchmark,
+}
+
+
+if __name__ == "__main__":
+    config.set_program_dirs(os.path.abspath("data"),
+                            os.path.abspath("temp"),
+                            os.path.abspath("program_files"))
+    config.set_user_files_dir(os.path.abspath("user_files"))
+
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
@@ -0,0 +1,146 @@
+"""
+Checks the HTTP layer of the song sources (sources.http_client) against a local http.server: retries on 503 and 429
+honouring Retry-After, no retries on 404, the token bucket's pacing, keep-alive connection reuse, and giving up on a
+refused connection. No network needed. Raises if a check fails.
+"""
+
+import socket
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import requests
+
+HOST = "127.0.0.1"
+# slack for timing checks, on top of the expected delay
+TIMING_TOLERANCE_SECONDS = 0.5
+
+
+class ScriptedHandler(BaseHTTPRequestHandler):
+    """
+    Answers GET /<name>?status=<code>&failures=<n>&retry_after=<value> with the status for the first n requests to
+    that path, and 200 after that. Counts requests per path, and the client ports they came from.
+    """
+    protocol_version = "HTTP/1.1"
+    requests_by_path = Counter()
+    client_ports = set()
+    lock = threading.Lock()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        with self.lock:
+            self.requests_by_path[url.path] += 1
+            self.client_ports.add(self.client_address[1])
+            count = self.requests_by_path[url.path]
+        if count <= int(params.get("failures", 0)):
+            status = int(params["status"])
+        else:
+            status = 200
+        self.send_response(status)
+        if status != 200 and "retry_after" in params:
+            self.send_header("Retry-After", params["retry_after"])
+        body = str(status).encode()
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def check_retries(base_url: str):
+    from sources.http_client import HttpClient
+    client = HttpClient(rate_per_second=None, base_delay=0.01, max_delay=0.05)
+
+    response = client.get(f"{base_url}/unavailable", params={"status": 503, "failures": 2, "retry_after": 0})
+    assert response.status_code == 200 and ScriptedHandler.requests_by_path["/unavailable"] == 3
+
+    start = time.monotonic()
+    response = client.get(f"{base_url}/throttled", params={"status": 429, "failures": 1, "retry_after": 1})
+    elapsed = time.monotonic() - start
+    assert response.status_code == 200 and ScriptedHandler.requests_by_path["/throttled"] == 2
+    assert 1.0 <= elapsed < 1.0 + TIMING_TOLERANCE_SECONDS, elapsed
+
+    response = client.get(f"{base_url}/missing", params={"status": 404, "failures": 100})
+    assert response.status_code == 404 and ScriptedHandler.requests_by_path["/missing"] == 1
+
+    try:
+        client.get(f"{base_url}/down", params={"status": 503, "failures": 100, "retry_after": 0})
+        raise AssertionError("expected the last attempt's error")
+    except requests.HTTPError as e:
+        assert e.response.status_code == 503
+    assert ScriptedHandler.requests_by_path["/down"] == client.max_attempts
+    client.close()
+    print("retries: 503 and 429 retried (Retry-After honoured), 404 not retried, gives up after max_attempts")
+
+
+def check_pacing(base_url: str):
+    from sources.http_client import HttpClient
+    rate, num_requests = 20.0, 21
+    client = HttpClient(rate_per_second=rate, burst=1)
+    start = time.monotonic()
+    for _ in range(num_requests):
+        client.get(f"{base_url}/paced")
+    elapsed = time.monotonic() - start
+    client.close()
+    # the first request takes the bucket's one token, each further one waits for the next
+    expected = (num_requests - 1) / rate
+    print(f"pacing: {num_requests} requests at {rate:g}/s took {elapsed:.2f}s, expected {expected:.2f}s")
+    assert expected <= elapsed < expected + TIMING_TOLERANCE_SECONDS
+
+
+def check_connection_reuse(base_url: str):
+    from sources.http_client import HttpClient
+    client = HttpClient(rate_per_second=None)
+    with ScriptedHandler.lock:
+        ScriptedHandler.client_ports.clear()
+    for _ in range(10):
+        client.get(f"{base_url}/reused")
+    client.close()
+    print(f"connection reuse: 10 requests over {len(ScriptedHandler.client_ports)} connection(s)")
+    assert len(ScriptedHandler.client_ports) == 1
+
+
+def check_connection_refused():
+    from sources.http_client import HttpClient
+    client = HttpClient(rate_per_second=None, max_attempts=3, base_delay=0.01, max_delay=0.05)
+    attempts = Counter()
+    request_once = client._request_once
+
+    def counting_request_once(*args, **kwargs):
+        attempts["refused"] += 1
+        return request_once(*args, **kwargs)
+
+    client._request_once = counting_request_once
+    try:
+        client.get(f"http://{HOST}:{_free_port()}/nothing-here")
+        raise AssertionError("expected a connection error")
+    except requests.ConnectionError:
+        pass
+    client.close()
+    print(f"connection refused: gave up after {attempts['refused']} attempts")
+    assert attempts["refused"] == client.max_attempts
+
+
+if __name__ == "__main__":
+    server = ThreadingHTTPServer((HOST, 0), ScriptedHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://{HOST}:{server.server_address[1]}"
+    try:
+        check_retries(base_url)
+        check_pacing(base_url)
+        check_connection_reuse(base_url)
+        check_connection_refused()
+    finally:
+        server.shutdown()
+        server.server_close()
+    print("ok")
@@ -0,0 +1,100 @@
+"""
+Stress check of the per-song coalescing of affect vector computations: many threads ask for playlists and playtrees
+on a cold library (no vector known yet) at once, and every song's vector must be computed exactly once. The model is
+replaced by a stub that counts its calls, so neither it nor any audio files are needed. Raises if the check fails.
+"""
+
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+from typing import Tuple
+
+import numpy as np
+
+from resonant import config
+
+NUM_SONGS = 40
+NUM_THREADS = 16
+QUERIES_PER_THREAD = 6
+PLAYLIST_LENGTH = 8
+# long enough for the threads to pile up on the songs being computed
+COMPUTE_SECONDS = 0.02
+
+
+def _set_dirs(root: str):
+    config.set_program_dirs(os.path.join(root, "data"), os.path.join(root, "temp"), os.path.join(root, "program_files"))
+    config.set_user_files_dir(os.path.join(root, "user_files"))
+    for directory in (config.music_dir, config.temp_dir, config.program_files_dir, config.user_files_dir):
+        os.makedirs(directory)
+
+
+def counting_analyzer():
+    from songaffect import AffectAnalyzer
+    from songaffect.persistent_cache import QUALITY_FULL
+
+    class CountingAffectAnalyzer(AffectAnalyzer):
+        """
+        AffectAnalyzer whose model is a stub returning a random vector per song, counting how often it's run per song.
+        """
+        def __init__(self):
+            super().__init__()
+            self.computations = Counter()
+            self._computations_lock = threading.Lock()
+
+        def _compute_affect_vector(self, song, preview: bool = False) -> Tuple[np.ndarray, str]:
+            with self._computations_lock:
+                self.computations[song.raw_name] += 1
+            time.sleep(COMPUTE_SECONDS)
+            vec = np.random.default_rng(abs(hash(song.raw_name))).standard_normal(1280)
+            return (vec / np.linalg.norm(vec)).astype(np.float32), QUALITY_FULL
+
+    return CountingAffectAnalyzer()
+
+
+def check_single_flight():
+    from graph import MusicGraph
+    from songmodel import KnownSong
+    from songrepository import SongRepository
+
+    song_repository = SongRepository()
+    song_repository.add_songs([KnownSong(f"Artist {i % 7}- Song {i}", f"Song {i}", f"Artist {i % 7}", f"{i:03d}.mp3")
+                               for i in range(NUM_SONGS)])
+    affect_analyzer = counting_analyzer()
+    music_graph = MusicGraph(song_repository, affect_analyzer)
+    songs = song_repository.get_all_songs()
+
+    errors = []
+    start = threading.Barrier(NUM_THREADS)
+
+    def run(seed: int):
+        try:
+            start.wait()
+            for i in range(QUERIES_PER_THREAD):
+                head = songs[(seed * QUERIES_PER_THREAD + i) % NUM_SONGS]
+                playlist = music_graph.get_playlist_from_song(head, PLAYLIST_LENGTH)
+                if i % 2:
+                    music_graph.get_tree_from_playlist(playlist, 2, [2, 1])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(seed,)) for seed in range(NUM_THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print(f"{NUM_THREADS} threads, {NUM_THREADS * QUERIES_PER_THREAD} queries: {len(errors)} errors, "
+          f"{sum(affect_analyzer.computations.values())} computations for {NUM_SONGS} songs")
+    assert not errors, errors
+    repeated = {raw_name: n for raw_name, n in affect_analyzer.computations.items() if n != 1}
+    assert not repeated, repeated
+    assert set(affect_analyzer.computations) == {song.raw_name for song in songs}
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as root:
+        _set_dirs(root)
+        check_single_flight()
+    print("ok")
@@ -0,0 +1,296 @@
+"""
+End-to-end load test of the API. Generates a fixture library (db rows, random affect vectors, tiny silent mp3s with
+embedded album art - no model or network needed), serves the app on it from a separate process, and replays the
+traffic of simulated listeners against it with http.client, at each of several concurrency levels. Reports latency
+percentiles and throughput per route.
+"""
+
+import gzip
+import http.client
+import json
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+from io import BytesIO
+from random import Random
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote, urlencode
+
+import numpy as np
+
+from resonant import config
+
+# library sizes to test, each with its own fixture (kept between runs) and server
+LIBRARY_SIZES = (1000, 5000)
+# simulated listeners sending requests at once
+CONCURRENCY_LEVELS = (1, 4, 16)
+# measured time per concurrency level, after a warm-up whose requests aren't counted
+DURATION_SECONDS = 20
+WARMUP_SECONDS = 3
+# generated libraries, kept in between runs - under the app's temp dir rather than next to the sources
+FIXTURE_DIR = os.path.abspath(os.path.join("temp", "loadtest_fixtures"))
+HOST = "127.0.0.1"
+PORT = 8765
+
+# the listeners' behaviour, modelled on app.js: after picking a song out of those sampled for a random one, they listen
+#  along its playlist, now and then taking a branch of the playtree instead
+SESSION_STEPS = 12
+BRANCH_PROBABILITY = 0.3
+NUM_ARTISTS = 200
+# the fixture's songs share this many mp3s (hard links), each with its own cover
+NUM_AUDIO_FILES = 16
+AUDIO_SECONDS = 1
+
+
+# fixture
+
+def _cover_png(rng: np.random.Generator) -> bytes:
+    import imageio.v2 as imageio
+    pixels = np.empty((64, 64, 3), dtype=np.uint8)
+    pixels[:] = rng.integers(0, 256, size=3, dtype=np.uint8)
+    buffer = BytesIO()
+    imageio.imwrite(buffer, pixels, format="png")
+    return buffer.getvalue()
+
+
+def _write_silent_mp3(path: str, cover: bytes):
+    from mutagen.id3 import ID3, APIC
+    # mpeg 1 layer 3, 128kbps, 44.1kHz, mono, all-zero side info and main data, which decodes to silence
+    frame = b"\xff\xfb\x90\xc0" + bytes(413)
+    with open(path, "wb") as f:
+        f.write(frame * int(np.ceil(AUDIO_SECONDS * 44100 / 1152)))
+    tags = ID3()
+    tags.add(APIC(encoding=3, mime="image/png", type=3, desc="Cover", data=cover))
+    tags.save(path)
+
+
+def _fixture_root(num_songs: int) -> str:
+    return os.path.join(FIXTURE_DIR, f"{num_songs}_songs")
+
+
+def _set_fixture_dirs(root: str):
+    config.set_program_dirs(os.path.join(root, "data"), os.path.join(root, "temp"), os.path.join(root, "program_files"))
+    config.set_user_files_dir(os.path.join(root, "user_files"))
+
+
+def make_fixture(num_songs: int):
+    """
+    Generate the fixture library of the passed size, unless it's there already. There's no model file, so the vectors
+    are stored untagged and nothing ever tries to run the model.
+    """
+    root = _fixture_root(num_songs)
+    complete_marker = os.path.join(root, "complete")
+    _set_fixture_dirs(root)
+    if os.path.exists(complete_marker):
+        return
+    shutil.rmtree(root, ignore_errors=True)
+    for directory in (config.music_dir, config.temp_dir, config.program_files_dir, config.user_files_dir):
+        os.makedirs(directory)
+
+    from songaffect.persistent_cache import AffectVectorCache
+    from songmodel import KnownSong
+    from songrepository import SongRepository
+
+    print(f"Generating a fixture library of {num_songs} songs in {root}")
+    rng = np.random.default_rng(num_songs)
+    audio_files = []
+    for i in range(NUM_AUDIO_FILES):
+        path = os.path.join(root, f"template_{i}.mp3")
+        _write_silent_mp3(path, _cover_png(rng))
+        audio_files.append(path)
+
+    songs = []
+    for i in range(num_songs):
+        filename = f"{i:06d}.mp3"
+        try:
+            os.link(audio_files[i % NUM_AUDIO_FILES], os.path.join(config.music_dir, filename))
+        except OSError:
+            shutil.copyfile(audio_files[i % NUM_AUDIO_FILES], os.path.join(config.music_dir, filename))
+        songs.append(KnownSong(f"Artist {i % NUM_ARTISTS}- Song {i}", f"Song {i}", f"Artist {i % NUM_ARTISTS}",
+                               filename))
+    SongRepository().add_songs(songs)
+
+    vector_cache = AffectVectorCache()
+    for song in songs:
+        vec = rng.standard_normal(1280).astype(np.float32)
+        vector_cache.insert_vector(song.raw_name, vec / np.linalg.norm(vec))
+    open(complete_marker, "w").close()
+
+
+# server
+
+def _serve(num_songs: int, port: int):
+    _set_fixture_dirs(_fixture_root(num_songs))
+
+    import uvicorn
+    from fastapi import FastAPI
+    from resonant.backend import router as api_router
+
+    app = FastAPI()
+    app.include_router(api_router)
+    uvicorn.run(app, host=HOST, port=port, log_level="warning")
+
+
+def _wait_until_serving(port: int, timeout: float = 60.0):
+    give_up_at = time.monotonic() + timeout
+    while True:
+        try:
+            conn = http.client.HTTPConnection(HOST, port, timeout=5)
+            conn.request("GET", "/sources")
+            conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            if time.monotonic() > give_up_at:
+                raise
+            time.sleep(0.2)
+
+
+# traffic
+
+class Results:
+    """
+    Latencies and failures per route, over all listeners.
+    """
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = dict()
+        self.failures: Dict[str, int] = dict()
+        self._lock = threading.Lock()
+
+    def add(self, route: str, latency: float, ok: bool):
+        with self._lock:
+            self.latencies.setdefault(route, []).append(latency)
+            if not ok:
+                self.failures[route] = self.failures.get(route, 0) + 1
+
+    def print_summary(self, duration: float):
+        print(f"{'requests':>9}{'rps':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'failed':>8}  route")
+        total = 0
+        for route, latencies in sorted(self.latencies.items()):
+            p50, p95, p99 = 1000 * np.percentile(latencies, [50, 95, 99])
+            print(f"{len(latencies):9d}{len(latencies) / duration:9.1f}{p50:9.2f}{p95:9.2f}{p99:9.2f}"
+                  f"{self.failures.get(route, 0):8d}  {route}")
+            total += len(latencies)
+        print(f"{total:9d}{total / duration:9.1f}  total")
+
+
+class Listener:
+    """
+    One simulated user of the frontend, on its own keep-alive connection. Like a browser, it only loads each album
+    art once.
+    """
+    def __init__(self, port: int, results: Results, record_from: float, stop_at: float, seed: int):
+        self.conn = http.client.HTTPConnection(HOST, port, timeout=60)
+        self.results = results
+        self.record_from = record_from
+        self.stop_at = stop_at
+        self.rng = Random(seed)
+        self.seen_album_art = set()
+
+    def get(self, route: str, path: str, params: Optional[list] = None):
+        if params:
+            path += "?" + urlencode(params)
+        start = time.perf_counter()
+        try:
+            self.conn.request("GET", path, headers={"Accept-Encoding": "gzip"})
+            response = self.conn.getresponse()
+            body = response.read()
+            if response.getheader("Content-Encoding") == "gzip":
+                body = gzip.decompress(body)
+            ok = 200 <= response.status < 300
+        except (OSError, http.client.HTTPException):
+            self.conn.close()
+            body, ok = None, False
+        if time.monotonic() >= self.record_from:
+            self.results.add(route, time.perf_counter() - start, ok)
+        return json.loads(body) if ok and body and route.startswith(("/songs", "/playlists", "/song_data")) else None
+
+    def album_art(self, raw_name: str):
+        if raw_name not in self.seen_album_art:
+            self.seen_album_art.add(raw_name)
+            self.get("/album-art/{raw_name}", f"/album-art/{quote(raw_name)}")
+
+    def play(self, raw_name: str):
+        self.get("/audio/{raw_name}", f"/audio/{quote(raw_name)}")
+        self.get("/song_data/display_artist_and_name/{raw_name}",
+                 f"/song_data/display_artist_and_name/{quote(raw_name)}")
+        self.album_art(raw_name)
+
+    def load_playtree(self, head: List[str]) -> Optional[Tuple[list, list, dict]]:
+        if len(head) == 1:
+            result = self.get("/playlists/playlist_from/{raw_name}", f"/playlists/playlist_from/{quote(head[0])}",
+                              [("with_playtree", "true")])
+        else:
+            result = self.get("/playlists/playlist_from_head", "/playlists/playlist_from_head",
+                              [("head_raw_names", raw_name) for raw_name in head] + [("with_playtree", "true")])
+        if result is not None:
+            for raw_name in result[0] + result[1]:
+                self.album_art(raw_name)
+        return result
+
+    def session(self):
+        random_song = self.get("/songs/random", "/songs/random")
+        if random_song is None: return
+        sampled = self.get("/songs/sampled_for/{raw_name}", f"/songs/sampled_for/{quote(random_song)}",
+                           [("qt_songs", 9)])
+        if not sampled: return
+        for raw_name in sampled:
+            self.album_art(raw_name)
+            self.get("/song_data/display_name/{raw_name}", f"/song_data/display_name/{quote(raw_name)}")
+
+        current = self.rng.choice(sampled)
+        self.play(current)
+        playtree = self.load_playtree([current])
+        position = 0
+        for _ in range(SESSION_STEPS):
+            if playtree is None or time.monotonic() >= self.stop_at: return
+            playlist, _, children = playtree
+            branches = [(i, child) for i, song in enumerate(playlist[:position + 1]) for child in children.get(song, [])]
+            if branches and self.rng.random() < BRANCH_PROBABILITY:
+                i, child = self.rng.choice(branches)
+                self.play(child)
+                playtree = self.load_playtree(playlist[:i + 1] + [child])
+                position = i + 1
+            elif position + 1 < len(playlist):
+                position += 1
+                self.play(playlist[position])
+            else:
+                # end of the playlist - the player requests the one from its last song
+                playtree = self.load_playtree([playlist[-1]])
+                position = 0
+
+    def run(self):
+        while time.monotonic() < self.stop_at:
+            self.session()
+        self.conn.close()
+
+
+def run_load(port: int, concurrency: int) -> Results:
+    results = Results()
+    record_from = time.monotonic() + WARMUP_SECONDS
+    stop_at = record_from + DURATION_SECONDS
+    listeners = [Listener(port, results, record_from, stop_at, seed) for seed in range(concurrency)]
+    threads = [threading.Thread(target=listener.run, daemon=True) for listener in listeners]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+if __name__ == "__main__":
+    for num_songs in LIBRARY_SIZES:
+        make_fixture(num_songs)
+        # a separate process, st. the listeners don't compete with the server for the GIL
+        server = multiprocessing.get_context("spawn").Process(target=_serve, args=(num_songs, PORT), daemon=True)
+        server.start()
+        try:
+            _wait_until_serving(PORT)
+            for concurrency in CONCURRENCY_LEVELS:
+                print(f"\n{num_songs} songs, {concurrency} concurrent listeners, {DURATION_SECONDS}s")
+                run_load(PORT, concurrency).print_summary(DURATION_SECONDS)
+        finally:
+            server.terminate()
+            server.join()
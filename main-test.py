@@ -12,6 +12,8 @@ from resonant.sources import YoutubeDownloadableSongSource
 from resonant.songrepository import SongRepository
 from songaffect import AffectAnalyzer
 from resonant.graph import MusicGraph
+from resonant.analytics import analyze_library
+from resonant.sync import SourceSync
 
 song_repository = SongRepository()
 affect_analyzer = AffectAnalyzer()
@@ -29,17 +31,11 @@ song_sources = [
 ]
 
 
-for song_source in song_sources:
-    print(f"Updating with new songs from [{song_source.get_name()}]")
-    song_repository.download_new_songs(song_source.get_newest_songs())
+print(f"Updating with new songs from {[song_source.get_name() for song_source in song_sources]}")
+print(SourceSync(song_repository).run(song_sources).as_dict())
 
 all_songs = song_repository.get_all_songs()
-for i, song_1 in enumerate(all_songs):
-    for song_2 in all_songs[:i]:
-        similarity = affect_analyzer.similarity(song_1, song_2)
-        print(similarity, song_1.repr_name, song_2.repr_name)
-        mirror_similarity = affect_analyzer.similarity(song_2, song_1)
-        assert abs(similarity - mirror_similarity) < 1e-10
+analyze_library(all_songs, affect_analyzer).print_summary()
 
 
 s = song_repository.get_random_song()
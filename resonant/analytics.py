@@ -0,0 +1,212 @@
+"""
+Library-wide similarity analytics. Computes the full song x song similarity structure without ever holding the N x N
+matrix: the affect vectors are written to a memory-mapped file once, and the upper triangle of the similarity matrix is
+computed block by block (a matmul of two row blocks of vectors at a time), each block being reduced to the few
+statistics we keep before moving on to the next. Memory use is O(N + block_size^2) regardless of library size.
+"""
+
+import os
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple, Optional, Iterator
+
+import numpy as np
+
+import config
+from songaffect import AffectAnalyzer
+from songmodel import KnownSong
+
+
+# rows per block - a 1024x1280 float32 block of vectors plus the 1024x1024 block of products they produce both fit in a
+#  typical L2/L3 cache
+BLOCK_SIZE = 1024
+# pairs at least this similar are reported as likely duplicates (the same track under different titles)
+NEAR_DUPLICATE_THRESHOLD = 0.995
+# stop collecting near duplicates beyond this many pairs, st. a bad threshold can't blow up memory
+MAX_NEAR_DUPLICATES = 10000
+HISTOGRAM_BINS = 100
+
+
+class SimilarityReport:
+    """
+    Result of analyze_library.
+    :ivar raw_names: the analyzed songs, indexing everything below.
+    :ivar near_duplicates: (raw_name_1, raw_name_2, similarity) of every pair above the threshold, most similar first.
+    :ivar nearest_neighbours: for each song, the index of its most similar other song.
+    :ivar nearest_neighbour_similarities: for each song, its similarity to that song.
+    :ivar histogram: counts of all pairwise similarities (each unordered pair once) over histogram_bin_edges.
+    """
+    def __init__(self, raw_names: List[str], near_duplicates: List[Tuple[str, str, float]],
+                 nearest_neighbours: np.ndarray, nearest_neighbour_similarities: np.ndarray,
+                 histogram: np.ndarray, histogram_bin_edges: np.ndarray):
+        self.raw_names = raw_names
+        self.near_duplicates = near_duplicates
+        self.nearest_neighbours = nearest_neighbours
+        self.nearest_neighbour_similarities = nearest_neighbour_similarities
+        self.histogram = histogram
+        self.histogram_bin_edges = histogram_bin_edges
+
+    def nearest_neighbour_stats(self) -> dict:
+        """
+        Summary of the nearest neighbour similarities - how tightly packed the library is.
+        """
+        s = self.nearest_neighbour_similarities
+        if not s.shape[0]: return dict()
+        return {
+            "mean": float(s.mean()),
+            "min": float(s.min()),
+            "p5": float(np.percentile(s, 5)),
+            "median": float(np.median(s)),
+            "p95": float(np.percentile(s, 95)),
+            "max": float(s.max()),
+        }
+
+    def print_summary(self, max_duplicates: int = 20):
+        print(f"{len(self.raw_names)} songs, {int(self.histogram.sum())} pairs")
+        print("Nearest neighbour similarity: " +
+              ", ".join(f"{k} {v:.4f}" for k, v in self.nearest_neighbour_stats().items()))
+        print(f"{len(self.near_duplicates)} likely duplicate pairs")
+        for raw_name_1, raw_name_2, similarity in self.near_duplicates[:max_duplicates]:
+            print(f"\t{similarity:.5f}  {raw_name_1}  <->  {raw_name_2}")
+        print("Similarity histogram:")
+        peak = max(int(self.histogram.max()), 1)
+        for count, low in zip(self.histogram, self.histogram_bin_edges):
+            if count:
+                print(f"\t{low:5.2f} {'#' * max(1, round(40 * count / peak))} {count}")
+
+
+def write_vector_file(songs: List[KnownSong], affect_analyzer: AffectAnalyzer, path: str) -> np.ndarray:
+    """
+    Write the affect vectors of the passed songs to a .npy file at the passed path, in order, and return it memory
+    mapped. Computes any vectors that aren't known yet, without caching them - the vectors go straight to the file
+    rather than through the analyzer's in-memory cache.
+    """
+    vectors = None
+    for i, song in enumerate(songs):
+        vec = affect_analyzer.get_affect_vector_uncached(song)
+        if vectors is None:
+            vectors = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(len(songs), vec.shape[0]))
+        vectors[i] = vec
+    vectors.flush()
+    return vectors
+
+
+def _block_ranges(n: int, block_size: int) -> List[Tuple[int, int]]:
+    return [(start, min(start + block_size, n)) for start in range(0, n, block_size)]
+
+
+def _analyze_row_block(vector_path: str, row_range: Tuple[int, int], block_size: int, threshold: float,
+                       max_near_duplicates: int, bin_edges: np.ndarray):
+    """
+    Process the row_range block row of the upper triangle of the similarity matrix, i.e. the similarities of those
+    rows' songs with themselves and every later song. Runs in worker processes, so it reads the vectors from file.
+
+    Returns the histogram of the block row, its near duplicate pairs and, since every block contributes nearest
+    neighbour candidates to both its rows and its columns, the best (similarity, index) found for every song from
+    row_range[0] on.
+    """
+    vectors = np.load(vector_path, mmap_mode="r")
+    n = vectors.shape[0]
+    r0, r1 = row_range
+    rows = np.ascontiguousarray(vectors[r0:r1])
+
+    best_similarity = np.full(n - r0, -np.inf, dtype=np.float32)
+    best_index = np.full(n - r0, -1, dtype=np.int64)
+    histogram = np.zeros(bin_edges.shape[0] - 1, dtype=np.int64)
+    near_duplicates = []
+
+    for c0, c1 in _block_ranges(n, block_size):
+        if c1 <= r0: continue
+        c0 = max(c0, r0)
+        block = rows @ vectors[c0:c1].T
+
+        if c0 == r0:
+            # diagonal block: only count each pair once, and never a song with itself
+            upper = np.triu(np.ones(block.shape, dtype=bool), k=1)
+            pair_similarities = block[upper]
+            # the lower triangle holds the same pairs mirrored, which is fine for the neighbour search
+            np.fill_diagonal(block, -np.inf)
+        else:
+            upper = None
+            pair_similarities = block.ravel()
+        histogram += np.histogram(np.clip(pair_similarities, bin_edges[0], bin_edges[-1]), bins=bin_edges)[0]
+
+        # nearest neighbour candidates, for the rows (best column) and the columns (best row)
+        for offset, axis, other_start in ((r0, 1, c0), (c0, 0, r0)):
+            idx = np.argmax(block, axis=axis)
+            sim = np.take_along_axis(block, np.expand_dims(idx, axis), axis=axis).squeeze(axis)
+            span = slice(offset - r0, offset - r0 + sim.shape[0])
+            better = sim > best_similarity[span]
+            best_similarity[span][better] = sim[better]
+            best_index[span][better] = idx[better] + other_start
+
+        if len(near_duplicates) < max_near_duplicates:
+            candidates = block >= threshold
+            if upper is not None:
+                candidates &= upper
+            for i, j in zip(*np.nonzero(candidates)):
+                near_duplicates.append((r0 + int(i), c0 + int(j), float(block[i, j])))
+
+    return histogram, near_duplicates[:max_near_duplicates], best_similarity, best_index
+
+
+def _analyze_blocks(vector_path: str, n: int, block_size: int, threshold: float, max_near_duplicates: int,
+                    bin_edges: np.ndarray, num_workers: Optional[int]) -> Iterator[Tuple[int, tuple]]:
+    row_ranges = _block_ranges(n, block_size)
+    args = (block_size, threshold, max_near_duplicates, bin_edges)
+    if not num_workers:
+        for row_range in row_ranges:
+            yield row_range[0], _analyze_row_block(vector_path, row_range, *args)
+        return
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        # keep at most two block rows per worker queued, st. finished results (O(N) each) don't pile up
+        pending = deque()
+        for row_range in row_ranges:
+            pending.append((row_range[0], pool.submit(_analyze_row_block, vector_path, row_range, *args)))
+            if len(pending) >= 2 * num_workers:
+                r0, future = pending.popleft()
+                yield r0, future.result()
+        for r0, future in pending:
+            yield r0, future.result()
+
+
+def analyze_library(songs: List[KnownSong], affect_analyzer: AffectAnalyzer,
+                    near_duplicate_threshold: float = NEAR_DUPLICATE_THRESHOLD,
+                    max_near_duplicates: int = MAX_NEAR_DUPLICATES, histogram_bins: int = HISTOGRAM_BINS,
+                    block_size: int = BLOCK_SIZE, num_workers: Optional[int] = None) -> SimilarityReport:
+    """
+    Compute near duplicates, nearest neighbours and the similarity histogram over all pairs of the passed songs.
+    :param num_workers: spread the block rows over a pool of this many processes. None computes everything in this
+     process (note that on platforms that spawn rather than fork, a pool requires the calling script to guard its
+     top-level code with if __name__ == "__main__").
+    """
+    raw_names = [song.raw_name for song in songs]
+    n = len(songs)
+    bin_edges = np.linspace(0.0, 1.0, histogram_bins + 1)
+    histogram = np.zeros(histogram_bins, dtype=np.int64)
+    nearest_similarity = np.full(n, -np.inf, dtype=np.float32)
+    nearest_index = np.full(n, -1, dtype=np.int64)
+    near_duplicates = []
+    if n < 2:
+        return SimilarityReport(raw_names, near_duplicates, nearest_index, nearest_similarity, histogram, bin_edges)
+
+    fd, vector_path = tempfile.mkstemp(suffix=".npy", dir=config.temp_dir or None)
+    os.close(fd)
+    try:
+        vectors = write_vector_file(songs, affect_analyzer, vector_path)
+        del vectors  # flushed, and the workers map the file themselves
+
+        for r0, (block_histogram, block_duplicates, block_similarity, block_index) in _analyze_blocks(
+                vector_path, n, block_size, near_duplicate_threshold, max_near_duplicates, bin_edges, num_workers):
+            histogram += block_histogram
+            near_duplicates.extend(block_duplicates)
+            better = block_similarity > nearest_similarity[r0:]
+            nearest_similarity[r0:][better] = block_similarity[better]
+            nearest_index[r0:][better] = block_index[better]
+    finally:
+        os.remove(vector_path)
+
+    near_duplicates.sort(key=lambda d: -d[2])
+    near_duplicates = [(raw_names[i], raw_names[j], sim) for i, j, sim in near_duplicates[:max_near_duplicates]]
+    return SimilarityReport(raw_names, near_duplicates, nearest_index, nearest_similarity, histogram, bin_edges)
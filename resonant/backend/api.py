@@ -1,11 +1,17 @@
-from typing import List, Tuple
+import json
+from typing import List, Tuple, Iterator, Optional
 
-from fastapi import APIRouter, HTTPException, Query
-from fastapi.responses import Response, FileResponse
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import Response, FileResponse, StreamingResponse
 from mutagen.id3 import ID3, APIC
 from mutagen.mp3 import MP3
+from pydantic import BaseModel
 
-from .state import song_repository, music_graph, song_sources
+from graph import Deadline
+from maintenance import reconcile_library
+from .serialization import json_response
+from .state import song_repository, affect_analyzer, music_graph, song_sources, playlist_cache, playlist_prefetcher, \
+    source_sync
 
 router = APIRouter()
 
@@ -21,7 +27,25 @@ def list_sources() -> List[str]:
 def update_from_source(source_name: str):
     source = next(filter(lambda s: s.get_name() == source_name, song_sources), None)
     assert source is not None # can only have been from list_sources()
-    song_repository.download_new_songs(source.get_newest_songs())
+    song_repository.update_from_source(source)
+
+
+@router.post("/sources/update_all")
+def update_from_all_sources():
+    """
+    Start updating from every source concurrently, in the background (unless an update is running already). Returns the
+    update's progress, as get_update_all_progress does.
+    """
+    return source_sync.start(song_sources).as_dict()
+
+
+@router.get("/sources/update_all/progress")
+def get_update_all_progress():
+    """
+    Return the progress of the current (or last) update from all sources, per source and in total. None if there's
+    been none yet.
+    """
+    return source_sync.progress.as_dict() if source_sync.progress is not None else None
 
 
 # songs
@@ -53,6 +77,22 @@ def get_sampled_songs(raw_name: str, qt_songs: int) -> List[str]:
     return [s.raw_name for s in sampled]
 
 
+@router.get("/songs/ids")
+def get_song_ids(request: Request) -> Response:
+    """
+    Return the stable integer id of every song, by raw name, for resolving the ids in compact responses. A song keeps
+    its id for good, so clients can keep this around and only refetch it when they meet an id they don't know.
+    """
+    return json_response(song_repository.get_song_ids(), request)
+
+
+def _raw_name_by_id(song_id: int) -> str:
+    raw_name = song_repository.get_raw_name_by_id(song_id)
+    if raw_name is None:
+        raise HTTPException(status_code=404, detail="Song not found")
+    return raw_name
+
+
 # song data
 
 @router.get("/song_data/display_name/{raw_name}")
@@ -80,6 +120,11 @@ def get_display_artist_and_name(raw_name: str) -> Tuple[str, str]:
         return "", song.raw_name
 
 
+@router.get("/song_data/display_artist_and_name/by_id/{song_id}")
+def get_display_artist_and_name_by_id(song_id: int) -> Tuple[str, str]:
+    return get_display_artist_and_name(_raw_name_by_id(song_id))
+
+
 @router.get("/audio/{raw_name}")
 def serve_audio(raw_name: str):
     song = song_repository.get_by_raw_name(raw_name)
@@ -88,6 +133,11 @@ def serve_audio(raw_name: str):
     return FileResponse(song.filepath, media_type="audio/mpeg")
 
 
+@router.get("/audio/by_id/{song_id}")
+def serve_audio_by_id(song_id: int):
+    return serve_audio(_raw_name_by_id(song_id))
+
+
 @router.get("/album-art/{raw_name}")
 def get_album_art(raw_name: str):
     song = song_repository.get_by_raw_name(raw_name)
@@ -105,50 +155,318 @@ def get_album_art(raw_name: str):
     raise HTTPException(status_code=404, detail="No album art found")
 
 
+@router.get("/album-art/by_id/{song_id}")
+def get_album_art_by_id(song_id: int):
+    return get_album_art(_raw_name_by_id(song_id))
+
+
 # playlist business
 
+PLAYTREE_MAX_DEPTH = 2
+PLAYTREE_MAX_CHILDREN_PER_DEPTH = (2, 2)
+DEGRADED_HEADER = "X-Resonant-Degraded"
+# how many playtree branches to speculatively compute the playtrees of, on top of the one for the playlist's last song
+PREFETCH_MAX_BRANCHES = 3
+
+
+def _compute_playlist_response(head_raw_names: Tuple[str, ...], num_songs: int, with_playtree: bool,
+                               deadline: Optional[Deadline] = None):
+    head = [song_repository.get_by_raw_name(raw_name) for raw_name in head_raw_names]
+    playlist = music_graph.get_playlist_from_head(head, num_songs, deadline)
+    if with_playtree:
+        added_songs, children = music_graph.get_tree_from_playlist(playlist, PLAYTREE_MAX_DEPTH,
+                                                                   list(PLAYTREE_MAX_CHILDREN_PER_DEPTH), deadline)
+        return (
+            [song.raw_name for song in playlist],
+            [song.raw_name for song in added_songs],
+            {song.raw_name: [s.raw_name for s in c] for song, c in children.items()}
+        )
+    else:
+        return [song.raw_name for song in playlist]
+
+
+def _playlist_cache_key(head_raw_names: List[str], num_songs: int, with_playtree: bool):
+    # the library and affect vector versions are part of the key, so any ingest, removal or preview vector upgrade
+    #  makes every previously cached result unreachable
+    return (
+        tuple(head_raw_names),
+        num_songs,
+        (PLAYTREE_MAX_DEPTH, PLAYTREE_MAX_CHILDREN_PER_DEPTH) if with_playtree else None,
+        song_repository.version,
+        affect_analyzer.version
+    )
+
+
+def _deadline(time_budget_ms: Optional[int]) -> Optional[Deadline]:
+    return Deadline(time_budget_ms / 1000) if time_budget_ms is not None else None
+
+
+def _playlist_response(head_raw_names: List[str], num_songs: int, with_playtree: bool,
+                       response: Optional[Response] = None, time_budget_ms: Optional[int] = None):
+    """
+    Cached wrapper over _compute_playlist_response. With a time budget, whether the result had to be degraded to meet
+    it is reported in the DEGRADED_HEADER response header - degraded results are not cached. Also schedules the
+    prefetching of the results likely to be requested next.
+    """
+    key = _playlist_cache_key(head_raw_names, num_songs, with_playtree)
+    found, result = playlist_cache.get(key)
+    if not found:
+        deadline = _deadline(time_budget_ms)
+        with playlist_prefetcher.foreground():
+            result = _compute_playlist_response(key[0], num_songs, with_playtree, deadline)
+        if deadline is None or not deadline.degraded:
+            playlist_cache.put(key, result)
+        if deadline is not None and response is not None:
+            response.headers[DEGRADED_HEADER] = "true" if deadline.degraded else "false"
+    elif time_budget_ms is not None and response is not None:
+        response.headers[DEGRADED_HEADER] = "false"
+
+    _prefetch_next(result, num_songs, with_playtree)
+    return result
+
+
+def _predicted_heads(result, with_playtree: bool) -> List[Tuple[str, ...]]:
+    """
+    Return the heads of the playlists the player is likely to request after the passed one, least likely first. That
+    is, following what app.js does: picking a branch of the playtree (requests the playlist through that branch), and
+    reaching the end of the playlist (requests the playlist from its last song).
+    """
+    if not with_playtree:
+        return [(result[-1],)]
+    playlist, _, children = result
+    branch_heads = [tuple(playlist[:i + 1]) + (children[song][0],)
+                    for i, song in enumerate(playlist[:-1]) if children.get(song)]
+    return branch_heads[:PREFETCH_MAX_BRANCHES][::-1] + [(playlist[-1],)]
+
+
+def _prefetch_next(result, num_songs: int, with_playtree: bool):
+    for head in _predicted_heads(result, with_playtree):
+        if len(head) > num_songs: continue
+        playlist_prefetcher.schedule(
+            _playlist_cache_key(list(head), num_songs, with_playtree),
+            lambda deadline, head=head: _compute_playlist_response(head, num_songs, with_playtree, deadline)
+        )
+
+
+# compact encoding, for compact=true. Songs are referred to by their ids (see get_song_ids) rather than raw names, and
+#  the playtree is sent as parent indices instead of a dict of children:
+#  - a playlist becomes {"songs": [id, ...]}
+#  - a playtree becomes {"songs": [id, ...], "parents": [index, ...], "playlist_length": n}, where songs starts with the
+#    n songs of the playlist, followed by the songs the playtree adds, and parents[i] is the index in songs of the
+#    parent of songs[i] (-1 for the first song). So within the playlist, parents[i] is just i - 1.
+
+def _compact_result(result, with_playtree: bool):
+    song_ids = song_repository.get_song_ids()
+    if not with_playtree:
+        return {"songs": [song_ids[raw_name] for raw_name in result]}
+    playlist, added_songs, children = result
+    songs = playlist + added_songs
+    index = {raw_name: i for i, raw_name in enumerate(songs)}
+    parents = [i - 1 for i in range(len(playlist))] + [-1] * len(added_songs)
+    for parent, parent_children in children.items():
+        for child in parent_children:
+            parents[index[child]] = index[parent]
+    return {"songs": [song_ids[raw_name] for raw_name in songs], "parents": parents, "playlist_length": len(playlist)}
+
+
+def _encode_result(result, with_playtree: bool, compact: bool):
+    return _compact_result(result, with_playtree) if compact else result
+
+
+def _playlist_json_response(result, with_playtree: bool, compact: bool, request: Request, response: Response):
+    encoded = json_response(_encode_result(result, with_playtree, compact), request)
+    # headers set on the injected response don't make it into one that's returned directly
+    if DEGRADED_HEADER in response.headers:
+        encoded.headers[DEGRADED_HEADER] = response.headers[DEGRADED_HEADER]
+    return encoded
+
+
 @router.get("/playlists/playlist_from/{root_raw_name}")
-def get_playlist_from(root_raw_name: str, num_songs: int = 8, with_playtree=False):
+def get_playlist_from(request: Request, response: Response, root_raw_name: str, num_songs: int = 8,
+                      with_playtree: bool = False, time_budget_ms: Optional[int] = None, compact: bool = False):
     """
     Return a playlist or playtree starting at the requested song.
     :param root_raw_name: Name of the song at which to start the playlist.
     :param num_songs: Desired length of the playlist
     :param with_playtree: bool, determining whether to return a sole playlist or accompany it with a playtree.
+    :param time_budget_ms: optional time to compute the result in, see graph.Deadline. If passed, the DEGRADED_HEADER
+     response header says whether the result is degraded.
+    :param compact: return the compact encoding described above instead.
     :return:
         - If `with_playtree` is False: a list of songs.
         - If `with_playtree` is True: a tuple (playlist, vertices, edges), representing the playlist and playtree.
     """
-    playlist = music_graph.get_playlist_from_song(song_repository.get_by_raw_name(root_raw_name), num_songs)
-    if with_playtree:
-        added_songs, children = music_graph.get_tree_from_playlist(playlist, 2, [2,2])
-        return (
-            [song.raw_name for song in playlist],
-            [song.raw_name for song in added_songs],
-            {song.raw_name: [s.raw_name for s in c] for song, c in children.items()}
-        )
-    else:
-        return [song.raw_name for song in playlist]
+    result = _playlist_response([root_raw_name], num_songs, with_playtree, response, time_budget_ms)
+    return _playlist_json_response(result, with_playtree, compact, request, response)
 
 
 @router.get("/playlists/playlist_from_head")
-def get_playlist_from_head(head_raw_names: List[str] = Query(...), num_songs: int = 8, with_playtree=False):
+def get_playlist_from_head(request: Request, response: Response, head_raw_names: List[str] = Query(...),
+                           num_songs: int = 8, with_playtree: bool = False, time_budget_ms: Optional[int] = None,
+                           compact: bool = False):
     """
     Return a playlist or playtree starting with the requested sequence of songs.
     :param head_raw_names: List of the songs to start the playlist with, in this order.
     :param num_songs: Desired length of the playlist
     :param with_playtree: bool, determining whether to return a sole playlist or accompany it with a playtree.
+    :param time_budget_ms: as in get_playlist_from.
+    :param compact: as in get_playlist_from.
     :return:
         - If `with_playtree` is False: a list of songs.
         - If `with_playtree` is True: a tuple (playlist, vertices, edges), representing the playlist and playtree.
     """
+    result = _playlist_response(head_raw_names, num_songs, with_playtree, response, time_budget_ms)
+    return _playlist_json_response(result, with_playtree, compact, request, response)
+
+
+class PlaylistQuery(BaseModel):
+    """
+    One query of a batch. The head is given either by raw names or by song ids.
+    """
+    head_raw_names: Optional[List[str]] = None
+    head_ids: Optional[List[int]] = None
+    num_songs: int = 8
+    with_playtree: bool = False
+
+
+@router.post("/playlists/batch")
+def get_playlists_batch(request: Request, queries: List[PlaylistQuery], compact: bool = False):
+    """
+    Answer several playlist/playtree queries in one request, e.g. the playtrees of all branches the player may take
+    next. Results go through the same cache as the single queries.
+    :param queries: the queries, see PlaylistQuery.
+    :param compact: as in get_playlist_from.
+    :return: the result of each query, in order, as get_playlist_from_head would return it.
+    """
+    results = []
+    for query in queries:
+        if query.head_raw_names is not None:
+            head_raw_names = query.head_raw_names
+        elif query.head_ids is not None:
+            head_raw_names = [_raw_name_by_id(song_id) for song_id in query.head_ids]
+        else:
+            raise HTTPException(status_code=422, detail="A query needs head_raw_names or head_ids")
+        result = _playlist_response(head_raw_names, query.num_songs, query.with_playtree)
+        results.append(_encode_result(result, query.with_playtree, compact))
+    return json_response(results, request)
+
+
+# streaming variants. Rather than one response once everything is computed, these send one json object per line
+#  (ndjson) as soon as it's known: first the playlist's songs, in order, as {"song": raw_name}, then if requested the
+#  playtree's edges as {"parent": raw_name, "child": raw_name}, and finally {"done": true, "degraded": bool}. The first
+#  song is sent before anything is computed, and every further song as soon as it's picked.
+
+def _ndjson_line(obj) -> bytes:
+    return (json.dumps(obj) + "\n").encode()
+
+
+# marks the end of an iterator for next()
+_END = object()
+
+
+def _in_foreground(iterator: Iterator) -> Iterator:
+    """
+    Iterate the passed iterator, keeping the prefetcher out of the way while each item is computed - but not while the
+    consumer holds on to it, st. a slow client doesn't hold up prefetching.
+    """
+    iterator = iter(iterator)
+    while True:
+        with playlist_prefetcher.foreground():
+            item = next(iterator, _END)
+        if item is _END:
+            return
+        yield item
+
+
+def _stream_playlist_lines(head_raw_names: List[str], num_songs: int, with_playtree: bool,
+                           time_budget_ms: Optional[int] = None) -> Iterator[bytes]:
+    key = _playlist_cache_key(head_raw_names, num_songs, with_playtree)
+    found, cached = playlist_cache.get(key)
+    if found:
+        playlist, _, children = cached if with_playtree else (cached, None, dict())
+        for raw_name in playlist:
+            yield _ndjson_line({"song": raw_name})
+        for parent, parent_children in children.items():
+            for child in parent_children:
+                yield _ndjson_line({"parent": parent, "child": child})
+        _prefetch_next(cached, num_songs, with_playtree)
+        yield _ndjson_line({"done": True, "degraded": False})
+        return
+
+    deadline = _deadline(time_budget_ms)
+    degraded = lambda: deadline is not None and deadline.degraded
     head = [song_repository.get_by_raw_name(raw_name) for raw_name in head_raw_names]
-    playlist = music_graph.get_playlist_from_head(head, num_songs)
-    if with_playtree:
-        added_songs, children = music_graph.get_tree_from_playlist(playlist, 2, [2,2])
-        return (
+    playlist = []
+    for song in _in_foreground(music_graph.iter_playlist_from_head(head, num_songs, deadline)):
+        playlist.append(song)
+        yield _ndjson_line({"song": song.raw_name})
+
+    if not with_playtree:
+        result = [song.raw_name for song in playlist]
+    else:
+        edges = []
+        for parent, child in _in_foreground(music_graph.iter_tree_from_playlist(
+                playlist, PLAYTREE_MAX_DEPTH, list(PLAYTREE_MAX_CHILDREN_PER_DEPTH), deadline)):
+            edges.append((parent, child))
+            yield _ndjson_line({"parent": parent.raw_name, "child": child.raw_name})
+        children = music_graph.children_from_edges(playlist, PLAYTREE_MAX_DEPTH, edges)
+        result = (
             [song.raw_name for song in playlist],
-            [song.raw_name for song in added_songs],
+            [song.raw_name for song in sum(children.values(), [])],
             {song.raw_name: [s.raw_name for s in c] for song, c in children.items()}
         )
-    else:
-        return [song.raw_name for song in playlist]
+    # only fully streamed results get cached - a client disconnecting midway closes the generator before this point
+    if not degraded():
+        playlist_cache.put(key, result)
+    _prefetch_next(result, num_songs, with_playtree)
+    yield _ndjson_line({"done": True, "degraded": degraded()})
+
+
+@router.get("/playlists/playlist_from/{root_raw_name}/stream")
+def stream_playlist_from(root_raw_name: str, num_songs: int = 8, with_playtree: bool = False,
+                         time_budget_ms: Optional[int] = None):
+    """
+    Streaming version of get_playlist_from, see above for the format.
+    """
+    return StreamingResponse(_stream_playlist_lines([root_raw_name], num_songs, with_playtree, time_budget_ms),
+                             media_type="application/x-ndjson")
+
+
+@router.get("/playlists/playlist_from_head/stream")
+def stream_playlist_from_head(head_raw_names: List[str] = Query(...), num_songs: int = 8, with_playtree: bool = False,
+                              time_budget_ms: Optional[int] = None):
+    """
+    Streaming version of get_playlist_from_head, see above for the format.
+    """
+    return StreamingResponse(_stream_playlist_lines(head_raw_names, num_songs, with_playtree, time_budget_ms),
+                             media_type="application/x-ndjson")
+
+
+# maintenance
+
+@router.post("/maintenance/reconcile")
+def reconcile(remove_orphaned_files: bool = True, remove_songs_missing_files: bool = False):
+    """
+    Delete orphaned mp3s and compact the affect vector store, see maintenance.reconcile_library. Returns what was
+    found and how much space was reclaimed.
+    """
+    return reconcile_library(song_repository, affect_analyzer, remove_orphaned_files=remove_orphaned_files,
+                             remove_songs_missing_files=remove_songs_missing_files).as_dict()
+
+
+# diagnostics
+
+@router.get("/stats/playlist_cache")
+def get_playlist_cache_stats():
+    """
+    Return size and hit/miss counters of the playlist/playtree result cache.
+    """
+    return playlist_cache.stats()
+
+
+@router.get("/stats/prefetch")
+def get_prefetch_stats():
+    """
+    Return counters of the playlist prefetcher - how many predictions were computed, and how many of those got used.
+    """
+    return playlist_prefetcher.stats()
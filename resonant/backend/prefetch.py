@@ -0,0 +1,149 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+from graph import Deadline
+from .result_cache import ResultCache
+
+
+logger = logging.getLogger(__name__)
+
+PREFETCH_TAG = "prefetch"
+
+
+class _YieldingDeadline(Deadline):
+    """
+    Deadline of a speculative computation, which steps out of the way of foreground requests rather than competing
+    with them for the cpu: while one is running, checking the deadline waits for it to finish. Only the time actually
+    spent computing counts against the budget, not the time spent waiting.
+    """
+    def __init__(self, seconds: float, prefetcher: "Prefetcher"):
+        super().__init__(seconds)
+        self.prefetcher = prefetcher
+
+    def expired(self) -> bool:
+        self.at += self.prefetcher.wait_for_foreground()
+        return super().expired()
+
+
+class Prefetcher:
+    """
+    Speculatively computes results that are likely to be requested next (e.g. the playtrees of the songs the user is
+    likely to pick from the current one) and puts them in a ResultCache, tagged st. the cache's stats tell how many of
+    them got used.
+
+    A single low-priority worker thread processes the predictions, newest first. It only runs while no foreground
+    request is being computed, pausing a computation whenever one starts, and gives each computation a bounded
+    time budget. Only the newest max_queued predictions are kept, older ones are dropped.
+    """
+
+    def __init__(self, cache: ResultCache, max_queued: int = 8, time_budget_seconds: float = 2.0):
+        self.cache = cache
+        self.max_queued = max_queued
+        self.time_budget_seconds = time_budget_seconds
+        self.foreground_active = 0
+        self._queue: deque[Tuple[Hashable, Callable[[Deadline], Any]]] = deque()
+        self._condition = threading.Condition()
+        self._worker = None
+
+        self.scheduled = 0
+        self.computed = 0
+        self.dropped = 0
+        self.abandoned = 0
+
+    @contextmanager
+    def foreground(self):
+        """
+        Wrap the computation of a foreground request in this, st. prefetching steps out of its way.
+        """
+        with self._condition:
+            self.foreground_active += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.foreground_active -= 1
+                self._condition.notify_all()
+
+    def wait_for_foreground(self) -> float:
+        """
+        Wait until no foreground request is being computed, returning how long that took.
+        """
+        with self._condition:
+            if not self.foreground_active:
+                return 0.0
+            start = time.monotonic()
+            while self.foreground_active:
+                self._condition.wait()
+            return time.monotonic() - start
+
+    def schedule(self, key: Hashable, compute: Callable[[Deadline], Any]):
+        """
+        Schedule the computation of the result for key, unless it's already cached. compute is called with a Deadline,
+        and its result is only kept if the deadline didn't force it to degrade. A key that's queued already just moves
+        up to the front of the queue.
+        """
+        if self.cache.contains(key):
+            return
+        with self._condition:
+            queued = next((task for task in self._queue if task[0] == key), None)
+            if queued is not None:
+                self._queue.remove(queued)
+                self._queue.append(queued)
+                return
+            self.scheduled += 1
+            self._queue.append((key, compute))
+            while len(self._queue) > self.max_queued:
+                self._queue.popleft()
+                self.dropped += 1
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="prefetch", daemon=True)
+                self._worker.start()
+            self._condition.notify_all()
+
+    def _next_task(self) -> Tuple[Hashable, Callable[[Deadline], Any]]:
+        with self._condition:
+            while not self._queue or self.foreground_active:
+                self._condition.wait()
+            return self._queue.pop()
+
+    def _run(self):
+        if hasattr(os, "setpriority"):
+            # on linux, nice values are per thread
+            try:
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 10)
+            except OSError:
+                pass
+
+        while True:
+            key, compute = self._next_task()
+            if self.cache.contains(key):
+                continue
+            deadline = _YieldingDeadline(self.time_budget_seconds, self)
+            try:
+                value = compute(deadline)
+            except Exception as e:
+                logger.warning("Prefetch of %r failed: %r", key, e)
+                continue
+            if deadline.degraded:
+                self.abandoned += 1
+                continue
+            self.cache.put(key, value, tag=PREFETCH_TAG)
+            self.computed += 1
+
+    def stats(self) -> Dict[str, Any]:
+        used = self.cache.stats()["first_hits_by_tag"].get(PREFETCH_TAG, 0)
+        with self._condition:
+            return {
+                "scheduled": self.scheduled,
+                "queued": len(self._queue),
+                "computed": self.computed,
+                "dropped": self.dropped,
+                "abandoned": self.abandoned,
+                "used": used,
+                "hit_rate": used / self.computed if self.computed else 0.0,
+            }
@@ -0,0 +1,76 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Tuple, Optional
+
+
+class ResultCache:
+    """
+    Thread-safe LRU cache for computed API results, bounded both in number of entries and in entry age (TTL).
+    Keys are expected to include whatever version information makes a result stale (e.g. the library version), so that
+    invalidation mostly happens by keys simply never being requested again and aging out of the LRU.
+
+    Entries can be tagged with where they came from (e.g. "prefetch"). The first hit on a tagged entry is counted
+    towards its tag in stats(), which tells how often entries of that origin ended up being used.
+    """
+
+    def __init__(self, max_size: int = 256, ttl_seconds: float = 600.0):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries: OrderedDict[Hashable, Tuple[float, Any, Optional[str]]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.first_hits_by_tag: Dict[str, int] = dict()
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        """
+        Return a tuple (found, value). An expired entry counts as a miss and is dropped.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None:
+                inserted_at, value, tag = entry
+                if now - inserted_at <= self.ttl_seconds:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    if tag is not None:
+                        self.first_hits_by_tag[tag] = self.first_hits_by_tag.get(tag, 0) + 1
+                        self._entries[key] = (inserted_at, value, None)
+                    return True, value
+                del self._entries[key]
+            self.misses += 1
+            return False, None
+
+    def contains(self, key: Hashable) -> bool:
+        """
+        Return whether there is a live entry for the key, without counting as a lookup.
+        """
+        with self._lock:
+            entry = self._entries.get(key, None)
+            return entry is not None and time.monotonic() - entry[0] <= self.ttl_seconds
+
+    def put(self, key: Hashable, value: Any, tag: Optional[str] = None):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value, tag)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "first_hits_by_tag": dict(self.first_hits_by_tag),
+            }
@@ -0,0 +1,45 @@
+"""
+Fast json responses for the larger API payloads (playtrees, batches). Serializes with orjson where it's installed,
+falling back on the standard json module, and gzips the body when it's large enough to be worth it and the client
+accepts it. Audio and album art are deliberately left alone - they're compressed already.
+"""
+
+import gzip
+import json
+from typing import Any
+
+from fastapi import Request
+from fastapi.responses import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# below this, gzip's header and the cpu time outweigh what it saves
+GZIP_MIN_BYTES = 1024
+# level 9 takes several times longer for a few percent on payloads like these
+GZIP_LEVEL = 5
+
+
+def dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+def _accepts_gzip(request: Request) -> bool:
+    return "gzip" in request.headers.get("accept-encoding", "").lower()
+
+
+def json_response(obj: Any, request: Request) -> Response:
+    """
+    Serialize obj into a json Response, gzipped if it's at least GZIP_MIN_BYTES and the request accepts gzip.
+    """
+    body = dumps(obj)
+    headers = {"Vary": "Accept-Encoding"}
+    if len(body) >= GZIP_MIN_BYTES and _accepts_gzip(request):
+        body = gzip.compress(body, compresslevel=GZIP_LEVEL)
+        headers["Content-Encoding"] = "gzip"
+    return Response(content=body, media_type="application/json", headers=headers)
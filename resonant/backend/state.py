@@ -1,8 +1,21 @@
+import config
 from graph import MusicGraph
+from sharding import ShardedSimilarityIndex
 from songrepository import SongRepository
 from songaffect import AffectAnalyzer
+from sync import SourceSync
+from .prefetch import Prefetcher
+from .result_cache import ResultCache
 
 song_repository = SongRepository()
-affect_analyzer = AffectAnalyzer()
-music_graph = MusicGraph(song_repository, affect_analyzer)
+# new songs get a quick preview vector at first, the full one is computed in the background
+affect_analyzer = AffectAnalyzer(preview_new_songs=True)
+affect_analyzer.upgrade_previews(song_repository.get_all_songs())
+# playlists and playtrees can search a sharded index (see sharding) rather than scanning every song in-process. its
+#  shards are started, and it's built, on the first playlist - not here at import time
+similarity_index = ShardedSimilarityIndex(config.similarity_shards) if config.similarity_shards else None
+music_graph = MusicGraph(song_repository, affect_analyzer, similarity_index)
 song_sources = []
+source_sync = SourceSync(song_repository)
+playlist_cache = ResultCache(max_size=256, ttl_seconds=600)
+playlist_prefetcher = Prefetcher(playlist_cache)
@@ -13,6 +13,9 @@ temp_dir = ""
 program_files_dir = ""
 user_files_dir = ""
 ffmpeg_path = ""
+similarity_shards = 0
+# ffmpeg runs at once over all downloads, 0 for one per cpu. read on the first transcode
+max_concurrent_transcodes = 0
 
 
 class ConfigObject(sys.__class__):
@@ -32,6 +35,12 @@ class ConfigObject(sys.__class__):
     def set_ffmpeg_path(self, ffmpeg_path: str):
         self.ffmpeg_path = ffmpeg_path
 
+    def set_similarity_shards(self, similarity_shards: int):
+        self.similarity_shards = similarity_shards
+
+    def set_max_concurrent_transcodes(self, max_concurrent_transcodes: int):
+        self.max_concurrent_transcodes = max_concurrent_transcodes
+
 
 # endows the module object with a class, st. import config; config.music_dir works
 sys.modules[__name__].__class__ = ConfigObject
@@ -1,6 +1,10 @@
+import time
+from collections import deque
+from contextlib import contextmanager
 from random import sample
-from typing import Tuple, List, Dict
+from typing import Tuple, List, Dict, Iterator, Iterable, Optional, Deque
 
+from sharding import ShardedSimilarityIndex, INITIAL_K, IndexState
 from songaffect import AffectAnalyzer
 from songmodel import KnownSong
 from songrepository import SongRepository
@@ -12,14 +16,41 @@ from songrepository import SongRepository
 #  this would be reasonable for a larger project but it's out of scope here - the performance impact is not significant
 
 
+# once past its deadline, a playlist picks each further song from a random sample of this many candidates
+DEGRADED_CANDIDATE_POOL = 256
+
+
+class Deadline:
+    """
+    A time by which a MusicGraph computation should be done. The graph methods that accept one cut corners as needed to
+    meet it - candidates are limited to songs whose vectors are already known (no model runs) if there isn't time to
+    compute the others, playlists pick from a sample of the remaining songs once the time is up, playtrees stop
+    branching - and set degraded if they had to.
+    :param seconds: time budget, from now.
+    """
+    def __init__(self, seconds: float):
+        self.at = time.monotonic() + seconds
+        self.degraded = False
+
+    def expired(self) -> bool:
+        return time.monotonic() >= self.at
+
+    def remaining(self) -> float:
+        return max(0.0, self.at - time.monotonic())
+
+
 class MusicGraph:
     """
     Uses the SongRepository and AffectAnalyzer to explore the space of songs with the metric induced by similarity.
     Produces playlists, playtrees, samples songs by similarity, etc.
+    :param similarity_index: optional ShardedSimilarityIndex to run the nearest neighbour searches of playlists and
+     playtrees on, rather than scanning every song in-process. Results are the same either way.
     """
-    def __init__(self, song_repository: SongRepository, affect_analyzer: AffectAnalyzer):
+    def __init__(self, song_repository: SongRepository, affect_analyzer: AffectAnalyzer,
+                 similarity_index: Optional[ShardedSimilarityIndex] = None):
         self.song_repository = song_repository
         self.affect_analyzer = affect_analyzer
+        self.similarity_index = similarity_index
 
     def get_sampled_songs_for(self, song: KnownSong, num_songs: int) -> List[KnownSong]:
         """
@@ -36,28 +67,95 @@ class MusicGraph:
         """
         return self.get_playlist_from_head([song], num_songs)
 
-    def get_playlist_from_head(self, head: List[KnownSong], num_songs: int) -> List[KnownSong]:
+    def _candidate_songs(self, excluded: List[KnownSong], num_needed: int,
+                         deadline: Optional[Deadline]) -> List[KnownSong]:
+        """
+        Return all songs that aren't excluded. Under a deadline that doesn't leave time to compute the missing vectors,
+        only those whose vectors are already known, as long as there are at least num_needed of them.
+        """
+        songs = [song for song in self.song_repository.get_all_songs() if song not in excluded]
+        if deadline is None:
+            return songs
+        known_songs = [song for song in songs if self.affect_analyzer.has_vector(song)]
+        if len(known_songs) == len(songs) or len(known_songs) < num_needed:
+            return songs
+        if not deadline.expired() and \
+                self.affect_analyzer.estimate_compute_seconds(len(songs) - len(known_songs)) < deadline.remaining():
+            return songs
+        deadline.degraded = True
+        return known_songs
+
+    @contextmanager
+    def _index_state(self, candidates: List[KnownSong], excluded: List[KnownSong]) -> Iterator[Optional[IndexState]]:
+        """
+        Yield the similarity index's state if the index can stand in for scanning the passed candidates, else None.
+        """
+        if self.similarity_index is None:
+            yield None
+            return
+        versions = (self.song_repository.version, self.affect_analyzer.version)
+        with self.similarity_index.use(versions, candidates, excluded) as state:
+            if state is None:
+                self.similarity_index.refresh(self.song_repository, self.affect_analyzer)
+            yield state
+
+    def _nearest(self, state: IndexState, nodes: List[KnownSong], excluded: List[KnownSong],
+                 k: int) -> List[List[Tuple[KnownSong, float]]]:
+        return self.similarity_index.nearest(state, [self.affect_analyzer.get_affect_vector(n) for n in nodes],
+                                             excluded, k, lambda j, s: self.affect_analyzer.similarity(nodes[j], s))
+
+    def get_playlist_from_head(self, head: List[KnownSong], num_songs: int,
+                               deadline: Optional[Deadline] = None) -> List[KnownSong]:
         """
         Return a playlist of the passed length, starting with the passed head (sequence of songs).
+        :param deadline: optional Deadline, see there.
+        """
+        return list(self.iter_playlist_from_head(head, num_songs, deadline))
+
+    def iter_playlist_from_head(self, head: List[KnownSong], num_songs: int,
+                                deadline: Optional[Deadline] = None) -> Iterator[KnownSong]:
+        """
+        Generator version of get_playlist_from_head - yields the playlist's songs one by one, as they are picked.
         """
         num_missing = num_songs - len(head)
         assert num_missing >= 0
 
         playlist = head[:]
-        if not num_missing: return playlist
+        yield from playlist
+        if not num_missing: return
 
+        selectable_songs = self._candidate_songs(playlist, num_missing, deadline)
+        with self._index_state(selectable_songs, playlist) as index_state:
+            if index_state is not None:
+                # the whole search runs while the index is held - not while the caller holds on to each song (e.g. a
+                #  stalled stream), which would keep the index from being rebuilt
+                picked = list(self._pick_songs(playlist, selectable_songs, num_missing, index_state, deadline))
+        if index_state is None:
+            picked = self._pick_songs(playlist, selectable_songs, num_missing, None, deadline)
+        yield from picked
+
+    def _pick_songs(self, playlist: List[KnownSong], selectable_songs: List[KnownSong], num_missing: int,
+                    index_state: Optional[IndexState], deadline: Optional[Deadline]) -> Iterator[KnownSong]:
+        """
+        Extend the playlist by num_missing of the selectable songs, yielding each as it's picked.
+        """
         current_song = playlist[-1]
-        selectable_songs = [song for song in self.song_repository.get_all_songs() if song not in playlist]
         for _ in range(num_missing):
-            next_song = max(selectable_songs, key=lambda s: self.affect_analyzer.similarity(s, current_song))
+            candidates = selectable_songs
+            if deadline is not None and deadline.expired() and len(selectable_songs) > DEGRADED_CANDIDATE_POOL:
+                deadline.degraded = True
+                candidates = sample(selectable_songs, DEGRADED_CANDIDATE_POOL)
+            elif index_state is not None:
+                candidates = [self._nearest(index_state, [current_song], playlist, 1)[0][0][0]]
+            next_song = max(candidates, key=lambda s: self.affect_analyzer.similarity(s, current_song))
 
             current_song = next_song
             playlist.append(current_song)
             selectable_songs.remove(current_song)
+            yield current_song
 
-        return playlist
-
-    def get_tree_from_playlist(self, playlist: List[KnownSong], max_depth: int, max_children_per_depth: List[int]) -> \
+    def get_tree_from_playlist(self, playlist: List[KnownSong], max_depth: int, max_children_per_depth: List[int],
+                               deadline: Optional[Deadline] = None) -> \
             Tuple[List[KnownSong], Dict[KnownSong, List[KnownSong]]]:
         """
         Takes a playlist and, interpreting as a (directed) path graph, expands it into a tree of alternative options
@@ -66,44 +164,96 @@ class MusicGraph:
         :param playlist: playlist to expand into a tree
         :param max_depth: max length of an alternative path going out from the playlist
         :param max_children_per_depth: list - max amount of children a node can have at each depth
+        :param deadline: optional Deadline, see there. Past it, no further children are added.
         :return: a tuple of all the new songs added, a dict specifying the child nodes of each song
         """
 
         if max_depth == 0:
             return [], dict()
 
+        edges = self.iter_tree_from_playlist(playlist, max_depth, max_children_per_depth, deadline)
+        children = self.children_from_edges(playlist, max_depth, edges)
+        added_nodes = sum(children.values(), [])
+        return added_nodes, children
+
+    @staticmethod
+    def children_from_edges(playlist: List[KnownSong], max_depth: int,
+                            edges: Iterable[Tuple[KnownSong, KnownSong]]) -> Dict[KnownSong, List[KnownSong]]:
+        """
+        Assemble the edges yielded by iter_tree_from_playlist into the children dict of get_tree_from_playlist.
+        """
+        # every playlist song but the last gets expanded, and so does every added song that isn't at max depth
+        depth = {song: 0 for song in playlist[:-max_depth]}
+        for i in range(1, max_depth):
+            depth[playlist[-i - 1]] = max_depth - i
+        children = {song: [] for song in depth}
+        for parent, child in edges:
+            children[parent].append(child)
+            if depth[parent] + 1 < max_depth:
+                depth[child] = depth[parent] + 1
+                children[child] = []
+        return children
+
+    def iter_tree_from_playlist(self, playlist: List[KnownSong], max_depth: int, max_children_per_depth: List[int],
+                                deadline: Optional[Deadline] = None) -> Iterator[Tuple[KnownSong, KnownSong]]:
+        """
+        Generator version of get_tree_from_playlist - yields the tree's edges, as (parent, child) tuples, in the order
+        the children are picked.
+        """
+
+        if max_depth == 0:
+            return
+
         to_expand_depth = {song: 0 for song in playlist[:-max_depth]}
         for i in range(1, max_depth):
             to_expand_depth[playlist[-i - 1]] = max_depth - i
 
-        children = {song: [] for song in to_expand_depth}
-
         to_expand_children = {song: max_children_per_depth[depth] for song, depth in to_expand_depth.items()}
 
-        other_songs = [song for song in self.song_repository.get_all_songs() if song not in playlist]
-        similarities = {song: {other_song: self.affect_analyzer.similarity(song, other_song)
-                               for other_song in other_songs}
-                        for song in to_expand_depth}
+        other_songs = self._candidate_songs(playlist, 1, deadline)
+        with self._index_state(other_songs, playlist) as index_state:
+            if index_state is not None:
+                # as in iter_playlist_from_head, done with the index before yielding
+                edges = list(self._iter_tree_on_index(index_state, playlist, other_songs, to_expand_depth,
+                                                      to_expand_children, max_depth, max_children_per_depth, deadline))
+        if index_state is not None:
+            yield from edges
+            return
+
+        similarities = dict()
+        for song in list(to_expand_depth):
+            if deadline is not None and deadline.expired():
+                # out of time before even getting to this song - it won't be expanded
+                deadline.degraded = True
+                to_expand_depth.pop(song)
+                to_expand_children.pop(song)
+                continue
+            similarities[song] = {other_song: self.affect_analyzer.similarity(song, other_song)
+                                  for other_song in other_songs}
 
         closest_other_song = {song: max(other_songs, key=similarities[song].__getitem__) for song in to_expand_depth}
         similarity_to_closest = {song: similarities[song][closest_other_song[song]] for song in to_expand_depth}
 
         while to_expand_depth:
 
+            if deadline is not None and deadline.expired():
+                deadline.degraded = True
+                break
+
             current_node = max(to_expand_depth, key=similarity_to_closest.__getitem__)
 
             new_node = closest_other_song[current_node]
 
-            children[current_node].append(new_node)
+            yield current_node, new_node
 
             # a reminder of all the exploration state - ensure that all of these are updated correctly
-            # children, to_expand_depth, to_expand_children, other_songs,
+            # to_expand_depth, to_expand_children, other_songs,
             # similarities, closest_other_song, similarity_to_closest
 
             # remove child from other songs, update closest_ and similarity_ accordingly
             other_songs.remove(new_node)
             if not other_songs:
-                # break early, so at this point we only have to care that children has the correct state
+                # no songs left to add
                 break
             for song in to_expand_depth:
                 # this covers current_node, too
@@ -115,7 +265,6 @@ class MusicGraph:
             current_depth = to_expand_depth[current_node]
             new_depth = current_depth + 1
             if new_depth < max_depth:
-                children[new_node] = []
                 to_expand_depth[new_node] = new_depth
                 to_expand_children[new_node] = max_children_per_depth[new_depth]
                 similarities[new_node] = {other_song: self.affect_analyzer.similarity(new_node, other_song) for
@@ -132,5 +281,77 @@ class MusicGraph:
                 closest_other_song.pop(current_node)
                 similarity_to_closest.pop(current_node)
 
-        added_nodes = sum(children.values(), [])
-        return added_nodes, children
+    def _iter_tree_on_index(self, index_state: IndexState, playlist: List[KnownSong], other_songs: List[KnownSong],
+                            to_expand_depth: Dict[KnownSong, int], to_expand_children: Dict[KnownSong, int],
+                            max_depth: int, max_children_per_depth: List[int],
+                            deadline: Optional[Deadline]) -> Iterator[Tuple[KnownSong, KnownSong]]:
+        """
+        iter_tree_from_playlist's search, on the similarity index. Rather than its similarity to every other song, each
+        node to expand keeps a ranking of its nearest other songs, refetched (twice as long) once all of them are taken.
+        """
+        remaining = set(other_songs)
+        excluded = playlist[:]
+        rankings: Dict[KnownSong, Deque[Tuple[KnownSong, float]]] = dict()
+        ranking_lengths: Dict[KnownSong, int] = dict()
+
+        def fetch_rankings(nodes: List[KnownSong], k: int):
+            for node, ranking in zip(nodes, self._nearest(index_state, nodes, excluded, k)):
+                rankings[node] = deque(ranking)
+                ranking_lengths[node] = k
+
+        def closest(node: KnownSong) -> Tuple[KnownSong, float]:
+            ranking = rankings[node]
+            while ranking and ranking[0][0] not in remaining:
+                ranking.popleft()
+            if not ranking:
+                fetch_rankings([node], 2 * ranking_lengths[node])
+                ranking = rankings[node]
+            return ranking[0]
+
+        for song in list(to_expand_depth):
+            if deadline is not None and deadline.expired():
+                deadline.degraded = True
+                to_expand_depth.pop(song)
+                to_expand_children.pop(song)
+        fetch_rankings(list(to_expand_depth), INITIAL_K)
+
+        closest_other_song = dict()
+        similarity_to_closest = dict()
+        for song in to_expand_depth:
+            closest_other_song[song], similarity_to_closest[song] = closest(song)
+
+        while to_expand_depth:
+
+            if deadline is not None and deadline.expired():
+                deadline.degraded = True
+                break
+
+            current_node = max(to_expand_depth, key=similarity_to_closest.__getitem__)
+
+            new_node = closest_other_song[current_node]
+
+            yield current_node, new_node
+
+            remaining.remove(new_node)
+            excluded.append(new_node)
+            if not remaining:
+                break
+            for song in to_expand_depth:
+                if closest_other_song[song] == new_node:
+                    closest_other_song[song], similarity_to_closest[song] = closest(song)
+
+            current_depth = to_expand_depth[current_node]
+            new_depth = current_depth + 1
+            if new_depth < max_depth:
+                to_expand_depth[new_node] = new_depth
+                to_expand_children[new_node] = max_children_per_depth[new_depth]
+                fetch_rankings([new_node], INITIAL_K)
+                closest_other_song[new_node], similarity_to_closest[new_node] = closest(new_node)
+
+            to_expand_children[current_node] -= 1
+            if to_expand_children[current_node] == 0:
+                to_expand_depth.pop(current_node)
+                to_expand_children.pop(current_node)
+                closest_other_song.pop(current_node)
+                similarity_to_closest.pop(current_node)
+                rankings.pop(current_node)
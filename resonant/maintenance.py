@@ -0,0 +1,93 @@
+import os
+import time
+from typing import Dict, Any, List
+
+import config
+from songaffect import AffectAnalyzer
+from songrepository import SongRepository
+
+
+# files modified more recently than this are never treated as orphans - they may have been written by another process
+#  that's about to add their song (downloads of this process are known to the repository, see below)
+ORPHAN_GRACE_SECONDS = 60 * 60
+
+
+class MaintenanceReport:
+    """
+    Summary of a reconcile_library run.
+    """
+    def __init__(self):
+        self.orphaned_files: List[str] = []
+        self.orphaned_file_bytes = 0
+        self.songs_missing_files: List[str] = []
+        self.songs_removed: List[str] = []
+        self.vectors_dropped = 0
+        self.vector_store_bytes_before = 0
+        self.vector_store_bytes_after = 0
+
+    @property
+    def reclaimed_bytes(self) -> int:
+        return self.orphaned_file_bytes + self.vector_store_bytes_before - self.vector_store_bytes_after
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "orphaned_files_removed": len(self.orphaned_files),
+            "orphaned_file_bytes": self.orphaned_file_bytes,
+            "songs_missing_files": self.songs_missing_files,
+            "songs_removed": self.songs_removed,
+            "vectors_dropped": self.vectors_dropped,
+            "vector_store_bytes_before": self.vector_store_bytes_before,
+            "vector_store_bytes_after": self.vector_store_bytes_after,
+            "reclaimed_bytes": self.reclaimed_bytes,
+        }
+
+
+def reconcile_library(song_repository: SongRepository, affect_analyzer: AffectAnalyzer,
+                      remove_orphaned_files: bool = True, remove_songs_missing_files: bool = False) -> MaintenanceReport:
+    """
+    Bring the song db, the affect vector store and the music directory back in line with each other, the db being the
+    source of truth:
+     - files in the music directory that no song refers to are deleted,
+     - songs whose mp3 is missing are reported (and optionally removed from the db),
+     - the vector store is compacted, dropping the vectors of songs no longer in the db and those of previous models.
+    Safe to run while the app is serving requests.
+    """
+    report = MaintenanceReport()
+
+    songs = song_repository.get_all_songs()
+    if remove_songs_missing_files:
+        for song in songs:
+            if not os.path.exists(song.filepath):
+                song_repository.remove_song_by_raw_name(song.raw_name)
+                report.songs_removed.append(song.raw_name)
+        songs = song_repository.get_all_songs()
+    report.songs_missing_files = [song.raw_name for song in songs if not os.path.exists(song.filepath)]
+
+    if remove_orphaned_files:
+        with os.scandir(config.music_dir) as entries:
+            files = [entry for entry in entries if entry.is_file()]
+        # the mtime alone can't tell fresh downloads apart (a hard-linked file keeps its source's), so skip those the
+        #  repository has pending. reading those before the songs means a file whose song is added meanwhile is in
+        #  one or the other
+        pending_filenames = song_repository.get_pending_filenames()
+        known_filenames = {song.filename for song in song_repository.get_all_songs()}
+        for entry in files:
+            if entry.name in known_filenames or entry.name in pending_filenames:
+                continue
+            stat = entry.stat()
+            if time.time() - stat.st_mtime < ORPHAN_GRACE_SECONDS:
+                continue
+            report.orphaned_file_bytes += stat.st_size
+            report.orphaned_files.append(entry.name)
+            os.remove(entry.path)
+
+    # the songs to keep are read once the compaction tracks writes, st. a song added (and analyzed) meanwhile keeps
+    #  its vector. likewise, only the in-memory vectors of songs gone from the db afterwards are dropped
+    size_before, size_after, num_dropped = affect_analyzer.persistent_cache.compact(
+        lambda: [song.raw_name for song in song_repository.get_all_songs()])
+    affect_analyzer.forget_removed_songs({song.raw_name for song in song_repository.get_all_songs()})
+    report.vector_store_bytes_before = size_before
+    report.vector_store_bytes_after = size_after
+    report.vectors_dropped = num_dropped
+
+    return report
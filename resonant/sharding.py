@@ -0,0 +1,352 @@
+"""
+Sharded similarity search, for MusicGraph. The affect vectors of the library are partitioned over several worker
+processes (local ones, or ones on other machines serving over multiprocessing.connection), each of which answers top-k
+queries over its partition with a single matmul. The coordinator scatters every query to all shards and merges their
+answers.
+
+Results are identical to MusicGraph's in-process scans: shards only preselect candidates, with a margin for rounding
+differences between the matmul and np.dot, and the coordinator rescores those with the very similarity function the
+in-process scan uses, breaking ties by library order just like max() does over the song list.
+"""
+
+import logging
+import multiprocessing
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing.connection import Client, Connection, Listener
+from queue import Queue
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from songmodel import KnownSong
+
+
+logger = logging.getLogger(__name__)
+
+# the matmul in the shards and the np.dot of the exact rescoring may round differently. for unit length float32 vectors
+#  that's on the order of 1e-6, so candidates within this much of the cutoff are kept and rescored
+RESCORE_MARGIN = 1e-4
+# neighbours fetched per query at first - a playtree node that has used them all up fetches twice as many
+INITIAL_K = 16
+# after a rebuild, don't start another for this long, st. a library that keeps changing (e.g. during a sync) doesn't
+#  keep the shards reloading
+MIN_REBUILD_INTERVAL_SECONDS = 30.0
+
+
+# shard side
+
+def _top_candidates(vectors: np.ndarray, positions: np.ndarray, queries: np.ndarray, excluded: np.ndarray,
+                    k: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """
+    For each query, return the (positions, approximate similarities) of the shard's k best songs that aren't excluded,
+    plus any within RESCORE_MARGIN of the k-th best.
+    """
+    scores = vectors @ queries.T
+    valid = ~np.isin(positions, excluded)
+    scores[~valid] = -np.inf
+    num_valid = int(valid.sum())
+    results = []
+    for j in range(queries.shape[0]):
+        column = scores[:, j]
+        if num_valid <= k:
+            picked = np.nonzero(valid)[0]
+        else:
+            cutoff = np.partition(column, -k)[-k]
+            picked = np.nonzero(column >= cutoff - RESCORE_MARGIN)[0]
+        results.append((positions[picked], column[picked]))
+    return results
+
+
+class _ShardData:
+    """
+    The partition a shard holds, shared by all connections to the shard. Replaced as a whole on load, st. a query
+    running meanwhile sees either the old partition or the new one.
+    """
+    def __init__(self):
+        # (positions, vectors)
+        self.partition: Tuple[np.ndarray, np.ndarray] = (np.empty(0, dtype=np.int64),
+                                                         np.empty((0, 0), dtype=np.float32))
+
+
+def _serve_connection(conn: Connection, data: _ShardData):
+    """
+    Answer a coordinator's requests on one connection until it closes it. Requests are tuples whose first item names
+    the command, and every request gets exactly one reply - an exception raised while handling it is sent back as the
+    reply.
+    """
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, OSError):
+            return
+        try:
+            command = request[0]
+            if command == "load":
+                _, positions, vectors = request
+                data.partition = (positions, vectors)
+                reply = positions.shape[0]
+            elif command == "top_k":
+                _, queries, excluded, k = request
+                positions, vectors = data.partition
+                reply = _top_candidates(vectors, positions, queries, excluded, k)
+            elif command == "close":
+                conn.close()
+                return
+            else:
+                raise ValueError(f"Unknown command {command!r}")
+        except Exception as e:
+            reply = e
+        conn.send(reply)
+
+
+def _serve_connections(conns: List[Connection]):
+    """
+    Serve each of the passed connections in its own thread (the matmuls release the GIL), until all are closed.
+    """
+    data = _ShardData()
+    threads = [threading.Thread(target=_serve_connection, args=(conn, data), daemon=True) for conn in conns]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def serve_shard(address: Tuple[str, int], authkey: bytes):
+    """
+    Serve as a shard on another machine: listen on address and answer the coordinator connecting to it (see the
+    addresses parameter of ShardedSimilarityIndex). Runs until killed, serving each connection in its own thread. The
+    connections share what the shard holds, so the shard is meant for a single coordinator.
+    """
+    data = _ShardData()
+    with Listener(address, authkey=authkey) as listener:
+        while True:
+            conn = listener.accept()
+            threading.Thread(target=_serve_connection, args=(conn, data), daemon=True).start()
+
+
+# coordinator side
+
+class IndexState:
+    """
+    What the shards currently hold: the indexed songs by position (their index in song_repository.get_all_songs()),
+    and the library and affect vector versions they were read at.
+    """
+    def __init__(self, versions: Tuple[int, int], songs: Dict[int, KnownSong]):
+        self.versions = versions
+        self.songs = songs
+        self.positions = {song: position for position, song in songs.items()}
+
+
+class ShardedSimilarityIndex:
+    """
+    The affect vectors of all songs that have one, spread over shards, for MusicGraph to run its nearest neighbour
+    searches on (see similarity_index there).
+
+    The index is (re)built in the background whenever the library or the vectors change. While it's out of date, or
+    doesn't hold every song a computation may pick (e.g. songs whose vectors are still being computed), use() yields
+    None and MusicGraph falls back on scanning in-process.
+
+    :param num_shards: number of local worker processes to start, on first use. These are spawned, so (as for any
+     spawned process) the calling script has to guard its top-level code with if __name__ == "__main__".
+    :param addresses: connect to shards served by serve_shard at these addresses instead of starting local ones.
+    :param authkey: the shards' authkey, with addresses.
+    :param num_channels: scatter-gather rounds that can run at once. Each has its own connection to every shard.
+    """
+
+    def __init__(self, num_shards: int = 4, addresses: Optional[List[Tuple[str, int]]] = None,
+                 authkey: Optional[bytes] = None, num_channels: int = 4):
+        self._addresses = addresses
+        self._authkey = authkey
+        self._num_shards = len(addresses) if addresses else num_shards
+        self._num_channels = num_channels
+        # the shards are started (or connected to) on the first round rather than here, st. constructing the index
+        #  at import time doesn't spawn processes while the importing module is still being imported
+        self._processes = []
+        self._channels: Optional[List[List[Connection]]] = None
+        self._start_lock = threading.Lock()
+        # channels not in use by a round
+        self._free_channels: Queue[List[Connection]] = Queue()
+
+        self._state: Optional[IndexState] = None
+        # use() counts its users, st. a rebuild can wait for them before replacing what the shards hold
+        self._users = 0
+        self._condition = threading.Condition()
+        self._building = False
+        self._last_build_at = -np.inf
+
+    @property
+    def num_shards(self) -> int:
+        return self._num_shards
+
+    def _start(self):
+        """
+        Start the local shard processes, or connect to the remote shards, unless that's done already.
+        """
+        with self._start_lock:
+            if self._channels is not None:
+                return
+            # channels[i][j] is channel i's connection to shard j
+            if self._addresses:
+                channels = [[Client(address, authkey=self._authkey) for address in self._addresses]
+                            for _ in range(self._num_channels)]
+            else:
+                context = multiprocessing.get_context("spawn")
+                channels = [[] for _ in range(self._num_channels)]
+                for i in range(self._num_shards):
+                    pipes = [context.Pipe() for _ in range(self._num_channels)]
+                    process = context.Process(target=_serve_connections, args=([child for _, child in pipes],),
+                                              name=f"similarity-shard-{i}", daemon=True)
+                    process.start()
+                    for channel, (parent_conn, child_conn) in zip(channels, pipes):
+                        child_conn.close()
+                        channel.append(parent_conn)
+                    self._processes.append(process)
+            for channel in channels:
+                self._free_channels.put(channel)
+            self._channels = channels
+
+    def _round(self, requests: List[tuple]) -> list:
+        """
+        Send each shard its request and return their replies, over a channel no other round is using.
+        """
+        self._start()
+        channel = self._free_channels.get()
+        try:
+            for conn, request in zip(channel, requests):
+                conn.send(request)
+            replies = [conn.recv() for conn in channel]
+        finally:
+            self._free_channels.put(channel)
+        for reply in replies:
+            if isinstance(reply, Exception):
+                raise reply
+        return replies
+
+    # building
+
+    def refresh(self, song_repository, affect_analyzer):
+        """
+        Start rebuilding the index in the background, unless a rebuild is running already or the last one was less than
+        MIN_REBUILD_INTERVAL_SECONDS ago.
+        """
+        with self._condition:
+            if self._building or time.monotonic() - self._last_build_at < MIN_REBUILD_INTERVAL_SECONDS:
+                return
+            self._building = True
+        threading.Thread(target=self._build, args=(song_repository, affect_analyzer), name="similarity-index-build",
+                         daemon=True).start()
+
+    def build(self, song_repository, affect_analyzer):
+        """
+        Rebuild the index now, blocking until done.
+        """
+        with self._condition:
+            while self._building:
+                self._condition.wait()
+            self._building = True
+        self._build(song_repository, affect_analyzer)
+
+    def _build(self, song_repository, affect_analyzer):
+        try:
+            # read the versions first - if anything changes while reading, the index is just out of date right away
+            versions = (song_repository.version, affect_analyzer.version)
+            # only persisted vectors - reading them all through the analyzer would keep them all in this process
+            all_songs = song_repository.get_all_songs()
+            persisted = affect_analyzer.persistent_cache.get_vectors(song.raw_name for song in all_songs)
+            vectors_by_position = {position: (song, persisted[song.raw_name])
+                                   for position, song in enumerate(all_songs) if song.raw_name in persisted}
+
+            with self._condition:
+                self._state = None
+                while self._users:
+                    self._condition.wait()
+
+            songs = dict()
+            dim = next(iter(vectors_by_position.values()))[1].shape[0] if vectors_by_position else 0
+            partitions = np.array_split(np.fromiter(vectors_by_position, dtype=np.int64), self.num_shards)
+            requests = []
+            for partition in partitions:
+                songs.update((int(p), vectors_by_position[p][0]) for p in partition)
+                vectors = np.empty((partition.shape[0], dim), dtype=np.float32)
+                for i, p in enumerate(partition):
+                    vectors[i] = vectors_by_position[p][1]
+                requests.append(("load", partition, vectors))
+            del vectors_by_position
+            self._round(requests)
+
+            with self._condition:
+                self._state = IndexState(versions, songs)
+        except Exception as e:
+            logger.warning("Failed to build similarity index: %r", e)
+        finally:
+            with self._condition:
+                self._building = False
+                self._last_build_at = time.monotonic()
+                self._condition.notify_all()
+
+    # querying
+
+    @contextmanager
+    def use(self, versions: Tuple[int, int], candidates: List[KnownSong],
+            excluded: Iterable[KnownSong]) -> Iterator[Optional[IndexState]]:
+        """
+        Yield the index's current state if it's at versions (library, affect vectors) and holds exactly the passed
+        candidates, once the excluded songs are taken out - otherwise None. The state stays valid until the context
+        exits.
+        """
+        with self._condition:
+            state = self._state
+            if state is None or state.versions != versions:
+                state = None
+            else:
+                num_excluded = sum(1 for song in set(excluded) if song in state.positions)
+                if len(candidates) != len(state.songs) - num_excluded or \
+                        not all(song in state.positions for song in candidates):
+                    state = None
+            if state is not None:
+                self._users += 1
+        try:
+            yield state
+        finally:
+            if state is not None:
+                with self._condition:
+                    self._users -= 1
+                    self._condition.notify_all()
+
+    def nearest(self, state: IndexState, queries: List[np.ndarray], excluded: Iterable[KnownSong], k: int,
+                score: Callable[[int, KnownSong], float]) -> List[List[Tuple[KnownSong, float]]]:
+        """
+        Return the k songs closest to each of the query vectors, excluding the passed songs, as (song, similarity)
+        pairs, most similar first (ties in library order). Fewer if there aren't k songs left.
+        :param state: as yielded by use().
+        :param score: the exact similarity, called with the index of the query and a candidate song.
+        """
+        excluded_positions = np.array(sorted(state.positions[song] for song in set(excluded) if song in state.positions),
+                                      dtype=np.int64)
+        query_matrix = np.array(queries, dtype=np.float32)
+        replies = self._round([("top_k", query_matrix, excluded_positions, k)] * self.num_shards)
+
+        results = []
+        for j in range(len(queries)):
+            positions = np.concatenate([reply[j][0] for reply in replies])
+            approximate = np.concatenate([reply[j][1] for reply in replies])
+            if positions.shape[0] > k:
+                # every shard sent its own top k, so anything that could be in the overall top k is in here
+                cutoff = np.partition(approximate, -k)[-k]
+                positions = positions[approximate >= cutoff - RESCORE_MARGIN]
+            scored = [(score(j, state.songs[int(p)]), int(p)) for p in positions]
+            scored.sort(key=lambda s: (-s[0], s[1]))
+            results.append([(state.songs[p], similarity) for similarity, p in scored[:k]])
+        return results
+
+    def close(self):
+        for conn in (conn for channel in self._channels or [] for conn in channel):
+            try:
+                conn.send(("close",))
+                conn.close()
+            except OSError:
+                pass
+        for process in self._processes:
+            process.join(timeout=5)
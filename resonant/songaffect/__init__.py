@@ -1 +1,2 @@
-from .affect_analyzer import AffectAnalyzer
\ No newline at end of file
+from .affect_analyzer import AffectAnalyzer
+from .inference import InferenceBackend, TensorflowBackend
\ No newline at end of file
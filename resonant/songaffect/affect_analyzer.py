@@ -1,41 +1,244 @@
-from typing import Dict
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from queue import Empty, Queue
+from typing import Dict, Iterable, Optional, Set, Tuple
 
 import numpy as np
 
 from songmodel import KnownSong
-from .affect_vector_extraction import extract_affect_vector
-from .persistent_cache import AffectVectorCache
+from .affect_vector_extraction import extract_affect_vector, model_fingerprint, count_patches, PREVIEW_NUM_PATCHES
+from .feature_cache import MelFeatureCache
+from .inference import InferenceBackend
+from .persistent_cache import AffectVectorCache, QUALITY_FULL, QUALITY_PREVIEW
+
+
+logger = logging.getLogger(__name__)
+
+# full vectors computed in the background are swapped in together, bumping the version at most once per this many
+#  seconds - st. a bulk import doesn't invalidate everything keyed on the version once per song
+UPGRADE_PUBLISH_INTERVAL_SECONDS = 10.0
+# what computing a song's vector on demand is assumed to take, until one has been timed
+DEFAULT_COMPUTE_SECONDS = 1.0
+# weight of the latest timing in the running estimate
+COMPUTE_SECONDS_SMOOTHING = 0.2
 
 
 class AffectAnalyzer:
-    def __init__(self):
-        self.persistent_cache = AffectVectorCache()
+    def __init__(self, cache_features: bool = False, inference_backend: Optional[InferenceBackend] = None,
+                 preview_new_songs: bool = False):
+        """
+        :param cache_features: whether to also persist the songs' log-mel spectrograms, st. recomputing vectors (e.g.
+         after the model is swapped, which invalidates all persisted vectors) only needs to re-run inference.
+        :param inference_backend: backend to run the model with (e.g. a TensorflowBackend with restricted threads).
+         Defaults to the shared TensorflowBackend with default settings.
+        :param preview_new_songs: whether songs without a vector should first get a quick preview vector (computed from
+         a few patches of the song), with the full vector computed in the background and swapped in once done.
+        """
+        self.persistent_cache = AffectVectorCache(model_fingerprint())
+        self.feature_cache = MelFeatureCache() if cache_features else None
+        self.inference_backend = inference_backend
+        self.preview_new_songs = preview_new_songs
         self.cache: Dict[str, np.ndarray] = dict()
+        self.quality: Dict[str, str] = dict()
+        # bumped whenever already handed out vectors are replaced (i.e. a batch of previews got upgraded), st. results
+        #  derived from vectors can be keyed on it
+        self.version = 0
+        # running estimate of how long computing a song's vector on demand takes, see estimate_compute_seconds
+        self.compute_seconds = DEFAULT_COMPUTE_SECONDS
 
-    def _affect_vector(self, song: KnownSong) -> np.ndarray:
+        # raw names with a vector in the persistent cache, loaded on first use of has_vector
+        self._persisted_raw_names: Optional[Set[str]] = None
+
+        # one in-flight lookup/computation per song - concurrent callers for the same song wait on its future
+        self._in_flight: Dict[str, Future] = dict()
+        self._in_flight_lock = threading.Lock()
+
+        self._upgrade_queue: Queue[KnownSong] = Queue()
+        self._queued_upgrades: Set[str] = set()
+        self._upgrade_lock = threading.Lock()
+        self._upgrade_worker: Optional[threading.Thread] = None
+
+    def _affect_vector(self, song: KnownSong, keep_in_memory: bool = True) -> np.ndarray:
         """
         Return an affect vector for the passed song. Get it from either of the caches of possible. Otherwise, compute
-        and insert into caches.
+        and insert into caches. Safe to call from several threads: if the song's vector is already being looked up or
+        computed, this waits for that rather than starting another computation.
+        :param keep_in_memory: whether a vector loaded or computed by this call goes into the in-memory cache. If not,
+         a computed vector is only persisted, and at full quality.
         """
         key = song.raw_name
         affect_vector = self.cache.get(key, None)
         if affect_vector is not None:
             return affect_vector
 
-        affect_vector = self.persistent_cache.get_vector(key)
-        if affect_vector is not None:
-            self.cache[key] = affect_vector
+        with self._in_flight_lock:
+            # re-check, the vector may have landed between the lookup above and taking the lock
+            affect_vector = self.cache.get(key, None)
+            if affect_vector is not None:
+                return affect_vector
+            future = self._in_flight.get(key, None)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self._in_flight[key] = future
+
+        if not is_owner:
+            return future.result()
+
+        try:
+            affect_vector = self._load_or_compute_affect_vector(song, keep_in_memory)
+            future.set_result(affect_vector)
             return affect_vector
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._in_flight_lock:
+                self._in_flight.pop(key)
+
+    def _load_or_compute_affect_vector(self, song: KnownSong, keep_in_memory: bool) -> np.ndarray:
+        key = song.raw_name
+        entry = self.persistent_cache.get_vector_and_quality(key)
+        if entry is not None:
+            affect_vector, quality = entry
+        else:
+            # a vector not kept in memory never gets upgraded, so it's computed in full right away
+            preview = self.preview_new_songs and keep_in_memory
+            start = time.perf_counter()
+            affect_vector, quality = self._compute_affect_vector(song, preview=preview)
+            self.compute_seconds += COMPUTE_SECONDS_SMOOTHING * (time.perf_counter() - start - self.compute_seconds)
+            self.persistent_cache.insert_vector(key, affect_vector, quality)
+            if self._persisted_raw_names is not None:
+                self._persisted_raw_names.add(key)
 
-        affect_vector = self._compute_affect_vector(song)
+        if not keep_in_memory:
+            return affect_vector
         self.cache[key] = affect_vector
-        self.persistent_cache.insert_vector(key, affect_vector)
+        self.quality[key] = quality
+        if quality == QUALITY_PREVIEW:
+            self._schedule_upgrade(song)
         return affect_vector
 
-    @staticmethod
-    def _compute_affect_vector(song: KnownSong) -> np.ndarray:
+    def _compute_affect_vector(self, song: KnownSong, preview: bool = False) -> Tuple[np.ndarray, str]:
         # the tf code may work w arbitrary resolution but in application we avoid using doubles
-        return extract_affect_vector(song.filepath).astype(np.float32)
+        total_patches = count_patches(song.filepath) if preview else None
+        if preview and total_patches > PREVIEW_NUM_PATCHES:
+            affect_vector = extract_affect_vector(song.filepath, backend=self.inference_backend,
+                                                  preview_patches=PREVIEW_NUM_PATCHES, total_patches=total_patches)
+            return affect_vector.astype(np.float32), QUALITY_PREVIEW
+        affect_vector = extract_affect_vector(song.filepath, feature_cache=self.feature_cache,
+                                              backend=self.inference_backend)
+        return affect_vector.astype(np.float32), QUALITY_FULL
+
+    def _schedule_upgrade(self, song: KnownSong):
+        with self._upgrade_lock:
+            if song.raw_name in self._queued_upgrades:
+                return
+            self._queued_upgrades.add(song.raw_name)
+            if self._upgrade_worker is None:
+                self._upgrade_worker = threading.Thread(target=self._run_upgrades, name="affect-vector-upgrades",
+                                                        daemon=True)
+                self._upgrade_worker.start()
+        self._upgrade_queue.put(song)
+
+    def _run_upgrades(self):
+        """
+        Background worker replacing preview vectors with full ones. Computes them one song at a time, and publishes them
+        in batches, see UPGRADE_PUBLISH_INTERVAL_SECONDS.
+        """
+        computed: Dict[str, Tuple[np.ndarray, str]] = dict()
+        last_published_at = -UPGRADE_PUBLISH_INTERVAL_SECONDS
+        while True:
+            # with upgrades waiting to be published, don't wait for more songs past the time to publish them
+            timeout = None
+            if computed:
+                timeout = max(0.0, last_published_at + UPGRADE_PUBLISH_INTERVAL_SECONDS - time.monotonic())
+            try:
+                song = self._upgrade_queue.get(timeout=timeout)
+            except Empty:
+                song = None
+
+            if song is not None:
+                try:
+                    computed[song.raw_name] = self._compute_affect_vector(song)
+                except Exception as e:
+                    # e.g. the song's file is briefly unavailable. its preview is dropped from memory, st. the next use
+                    #  loads it again and reschedules the upgrade
+                    logger.warning("Failed to compute full affect vector for %s: %r", song.raw_name, e)
+                    with self._upgrade_lock:
+                        self._queued_upgrades.discard(song.raw_name)
+                    if self.quality.get(song.raw_name) == QUALITY_PREVIEW:
+                        self.cache.pop(song.raw_name, None)
+                        self.quality.pop(song.raw_name, None)
+
+            if computed and time.monotonic() - last_published_at >= UPGRADE_PUBLISH_INTERVAL_SECONDS:
+                self._publish_upgrades(computed)
+                computed = dict()
+                last_published_at = time.monotonic()
+
+    def _publish_upgrades(self, computed: Dict[str, Tuple[np.ndarray, str]]):
+        for raw_name, (affect_vector, quality) in computed.items():
+            try:
+                self.persistent_cache.insert_vector(raw_name, affect_vector, quality)
+            except Exception as e:
+                logger.warning("Failed to store full affect vector for %s: %r", raw_name, e)
+                continue
+            self.cache[raw_name] = affect_vector
+            self.quality[raw_name] = quality
+        self.version += 1
+        with self._upgrade_lock:
+            self._queued_upgrades.difference_update(computed)
+
+    def upgrade_previews(self, songs: Iterable[KnownSong]):
+        """
+        Schedule the background computation of full vectors for those of the passed songs that only have a preview.
+        """
+        preview_raw_names = set(self.persistent_cache.get_preview_raw_names())
+        for song in songs:
+            if song.raw_name in preview_raw_names:
+                self._schedule_upgrade(song)
+
+    def has_vector(self, song: KnownSong) -> bool:
+        """
+        Return whether the song's vector is already known, i.e. whether using it is cheap (no model run).
+        """
+        if song.raw_name in self.cache:
+            return True
+        if self._persisted_raw_names is None:
+            self._persisted_raw_names = set(self.persistent_cache.get_current_raw_names())
+        return song.raw_name in self._persisted_raw_names
+
+    def forget_removed_songs(self, live_raw_names: Set[str]):
+        """
+        Drop the in-memory vectors of the songs not among the passed (live) ones, and reload which songs have a
+        persisted vector on next use. For after the persistent cache has been compacted.
+        """
+        for raw_name in [raw_name for raw_name in self.cache if raw_name not in live_raw_names]:
+            self.cache.pop(raw_name, None)
+            self.quality.pop(raw_name, None)
+        self._persisted_raw_names = None
+
+    def estimate_compute_seconds(self, num_songs: int) -> float:
+        """
+        Return roughly how long getting the vectors of num_songs songs that don't have one yet would take.
+        """
+        return num_songs * self.compute_seconds
+
+    def get_affect_vector(self, song: KnownSong) -> np.ndarray:
+        """
+        Return the song's (unit length) affect vector, computing it if it isn't known yet.
+        """
+        return self._affect_vector(song)
+
+    def get_affect_vector_uncached(self, song: KnownSong) -> np.ndarray:
+        """
+        Return the song's affect vector without keeping it in memory: read from the persistent cache, or if it isn't
+        there, computed (at full quality) and only persisted. For passes over the whole library, which would otherwise
+        pull every vector into the in-memory cache.
+        """
+        return self._affect_vector(song, keep_in_memory=False)
 
     def similarity(self, song1: KnownSong, song2: KnownSong) -> float:
         """
@@ -2,7 +2,9 @@
 This file handles the usage of essentia models (particularly discogs-bs4) to extract vectors encoding the emotional
 affect of songs.
 
-This is not really meant to be messed with - the only function that is intended to be public is extract_affect_vector.
+This is not really meant to be messed with - the only function that is intended to be public is extract_affect_vector
+(plus the helpers locating and fingerprinting the model file). The model itself is run by an InferenceBackend, see
+inference.py.
 
 It bears mentioning that there is some complication in how the (mel) spectrograms are computed that might be worthwhile
 to tease out in the future - particularly the channel expansion step, essentia seems to use some kind of triangular
@@ -11,13 +13,19 @@ through the internals of the relevant packages.
 """
 
 import os
-from typing import Any
+import threading
+from typing import Any, Iterator, Optional
 
 import numpy as np
 import librosa
-from scipy.signal import get_window
+import soundfile
+import soxr
 
 import config
+from util import file_content_hash
+from .feature_cache import MelFeatureCache
+from .inference import InferenceBackend, TensorflowBackend, BATCH_SIZE
+from .spectrogram import get_frontend
 
 
 # Constants
@@ -25,99 +33,298 @@ SR = 16000
 N_MELS = 128
 N_FRAMES = 96
 
-def _audio_to_mel_patches(
+def _audio_to_log_mel(
     filepath,
     sr=16000,
     n_mels=96,
-    patch_size=128,
-    hop_size=64,
     fft_size=512,
     mel_hop=256,
     scale=10000.0,
     eps=1e-10):
+    """
+    Return the log-mel spectrogram of the file as an array of shape (num_frames, n_mels).
+    """
     y, _ = librosa.load(filepath, sr=sr, mono=True)
+    frontend = get_frontend(sr=sr, n_mels=n_mels, fft_size=fft_size, mel_hop=mel_hop, scale=scale, eps=eps)
+    return frontend.log_mel(y)
 
-    # Use a Hann window with no normalization (as in Essentia)
-    window = get_window("hann", fft_size, fftbins=True)
-
-    # Compute STFT manually to control all steps
-    S = librosa.stft(
-        y,
-        n_fft=fft_size,
-        hop_length=mel_hop,
-        win_length=fft_size,
-        window=window,
-        center=True
-    )
-    magnitude = np.abs(S)
-
-    # Mel filter bank matching Essentia parameters
-    mel_basis = librosa.filters.mel(
-        sr=sr,
-        n_fft=fft_size,
-        n_mels=n_mels,
-        fmin=0.0,
-        fmax=sr / 2,
-        htk=False,      # Use Slaney-style Mel scale
-        norm=None       # Match Essentia's "unit_tri"
-    )
-
-    mel = np.dot(mel_basis, magnitude**2)
-
-    # Essentia-style compression: log10(1 + scale * mel)
-    log_mel = np.log10(1.0 + scale * mel + eps)  # Add eps to avoid log(0)
 
+def _log_mel_to_patches(log_mel, patch_size=128, hop_size=64):
     # Generate patches of shape (128, 96)
     patches = []
-    for start in range(0, log_mel.shape[1] - patch_size + 1, hop_size):
-        patch = log_mel[:, start:start + patch_size]
-        patches.append(patch.T)  # Transpose to (128, 96)
+    for start in range(0, log_mel.shape[0] - patch_size + 1, hop_size):
+        patches.append(log_mel[start:start + patch_size])
 
     return np.stack(patches, axis=0)  # shape: (num_patches, 128, 96)
 
 
+def _audio_to_mel_patches(
+    filepath,
+    sr=16000,
+    n_mels=96,
+    patch_size=128,
+    hop_size=64,
+    fft_size=512,
+    mel_hop=256,
+    scale=10000.0,
+    eps=1e-10):
+    log_mel = _audio_to_log_mel(filepath, sr=sr, n_mels=n_mels, fft_size=fft_size, mel_hop=mel_hop, scale=scale,
+                                eps=eps)
+    return _log_mel_to_patches(log_mel, patch_size=patch_size, hop_size=hop_size)
+
 
-BATCH_SIZE = 64
-INPUT_TENSOR_NAME = "serving_default_melspectrogram:0"
-OUTPUT_TENSOR_NAME = "PartitionedCall:1"
+MODEL_FILENAME = "discogs-effnet-bs64-1.pb"
 
+_default_backend = None
+_default_backend_lock = threading.Lock()
 
-def _run_model_on_patches(pb_path, patches):
 
-    # ugly, but avoids losing 5s to tf startup on every execution
-    import tensorflow as tf
+def default_backend() -> InferenceBackend:
+    """
+    Return the process-wide TensorFlow backend (default settings), creating it on first use. It's kept around st. the
+    model is loaded once rather than once per song.
+    """
+    global _default_backend
+    with _default_backend_lock:
+        if _default_backend is None:
+            _default_backend = TensorflowBackend(model_path())
+        return _default_backend
 
-    graph_def = tf.compat.v1.GraphDef()
-    with tf.io.gfile.GFile(pb_path, 'rb') as f:
-        graph_def.ParseFromString(f.read())
 
-    with tf.Graph().as_default() as graph:
-        tf.import_graph_def(graph_def, name="")
-        input_tensor = graph.get_tensor_by_name(INPUT_TENSOR_NAME)
-        output_tensor = graph.get_tensor_by_name(OUTPUT_TENSOR_NAME)
+# streaming variant of the whole-file path. _audio_to_mel_patches holds the whole decoded track and its full spectrogram in memory,
+#  which is fine for songs but not for multi-hour mixes. The streaming path decodes and resamples in blocks, carries the
+#  STFT/patch overlap across block edges, and keeps only a running sum of the model outputs, so its peak memory does not
+#  depend on track length. Up to resampling/fft rounding it produces the same patches as _audio_to_mel_patches.
 
-        with tf.compat.v1.Session(graph=graph) as sess:
-            num_patches = patches.shape[0]
-            # Possibly batch in 64s, depending on model constraint
-            outputs = []
-            for i in range(0, num_patches, 64):
-                batch = patches[i:i + 64]
-                if batch.shape[0] < 64:
-                    pad_len = 64 - batch.shape[0]
-                    pad = np.zeros((pad_len, 128, 96), dtype=np.float32)
-                    batch = np.concatenate([batch, pad], axis=0)
-                out = sess.run(output_tensor, feed_dict={input_tensor: batch})
-                outputs.append(out[:batch.shape[0]])
-            return np.concatenate(outputs, axis=0)
+STREAMING_BLOCK_SECONDS = 30.0
+# tracks at least this long are analysed in streaming mode unless the caller says otherwise
+STREAMING_MIN_DURATION_SECONDS = 20 * 60
 
 
-def extract_affect_vector(filepath: str) -> np.ndarray:
+def _stream_audio_blocks(filepath, sr=16000, block_seconds=STREAMING_BLOCK_SECONDS) -> Iterator[np.ndarray]:
+    """
+    Yield the file's audio as consecutive mono float32 blocks at the requested sample rate. Downmixing and (soxr, HQ)
+    resampling match what librosa.load does on the whole file.
+    """
+    with soundfile.SoundFile(filepath) as f:
+        resampler = None
+        if f.samplerate != sr:
+            resampler = soxr.ResampleStream(f.samplerate, sr, 1, dtype="float32", quality="HQ")
+        block_frames = int(block_seconds * f.samplerate)
+        while True:
+            block = f.read(block_frames, dtype="float32", always_2d=True)
+            is_last = block.shape[0] < block_frames
+            mono = block.mean(axis=1)
+            if resampler is not None:
+                mono = resampler.resample_chunk(mono, last=is_last)
+            if mono.shape[0]:
+                yield mono
+            if is_last:
+                return
+
+
+def _stream_log_mel_frames(
+    blocks: Iterator[np.ndarray],
+    sr=16000,
+    n_mels=96,
+    fft_size=512,
+    mel_hop=256,
+    scale=10000.0,
+    eps=1e-10) -> Iterator[np.ndarray]:
+    """
+    Incremental equivalent of MelSpectrogramFrontend.log_mel, carrying the framing overlap across block edges. Yields
+    arrays of shape (num_frames, n_mels).
+    """
+    frontend = get_frontend(sr=sr, n_mels=n_mels, fft_size=fft_size, mel_hop=mel_hop, scale=scale, eps=eps)
+
+    # samples not yet fully consumed by a frame, starting at the next frame's first sample
+    pending = np.zeros(fft_size // 2, dtype=np.float32)
+    for block in blocks:
+        pending = np.concatenate([pending, block])
+        num_frames = (pending.shape[0] - fft_size) // mel_hop + 1 if pending.shape[0] >= fft_size else 0
+        if num_frames:
+            yield frontend.frames_to_log_mel(pending, num_frames)
+            pending = pending[num_frames * mel_hop:]
+
+    pending = np.concatenate([pending, np.zeros(fft_size // 2, dtype=np.float32)])
+    if pending.shape[0] >= fft_size:
+        yield frontend.frames_to_log_mel(pending, (pending.shape[0] - fft_size) // mel_hop + 1)
+
+
+def _stream_patch_batches(
+    log_mel_frames: Iterator[np.ndarray],
+    patch_size=128,
+    hop_size=64,
+    batch_size=BATCH_SIZE) -> Iterator[np.ndarray]:
+    """
+    Cut a stream of log-mel frames into the same (patch_size, n_mels) patches as _audio_to_mel_patches, yielding them
+    in batches of at most batch_size.
+    """
+    pending = None
+    batch = []
+    for frames in log_mel_frames:
+        pending = frames if pending is None else np.concatenate([pending, frames])
+        num_patches = (pending.shape[0] - patch_size) // hop_size + 1 if pending.shape[0] >= patch_size else 0
+        for i in range(num_patches):
+            batch.append(pending[i * hop_size:i * hop_size + patch_size])
+            if len(batch) == batch_size:
+                yield np.stack(batch).astype(np.float32)
+                batch = []
+        # copy, st. the retained tail doesn't keep the whole block alive through a view
+        pending = pending[num_patches * hop_size:].copy()
+    if batch:
+        yield np.stack(batch).astype(np.float32)
+
+
+def _batched_patches(patches: np.ndarray, batch_size=BATCH_SIZE) -> Iterator[np.ndarray]:
+    for i in range(0, patches.shape[0], batch_size):
+        yield patches[i:i + batch_size]
+
+
+def _mean_prediction(patch_batches: Iterator[np.ndarray], backend: InferenceBackend) -> np.ndarray:
+    """
+    Run the model over a stream of patch batches, keeping only the running sum of its outputs.
+    """
+    prediction_sum = None
+    num_patches = 0
+    for batch in patch_batches:
+        preds = backend.predict(batch)
+        batch_sum = preds.sum(axis=0, dtype=np.float64)
+        prediction_sum = batch_sum if prediction_sum is None else prediction_sum + batch_sum
+        num_patches += preds.shape[0]
+    if not num_patches:
+        raise ValueError("Audio too short to extract an affect vector from")
+    return prediction_sum / num_patches
+
+
+def _should_stream(filepath) -> bool:
+    try:
+        return soundfile.info(filepath).duration >= STREAMING_MIN_DURATION_SECONDS
+    except RuntimeError:
+        # format soundfile can't read - librosa.load will fall back to audioread, which has no block interface
+        return False
+
+
+# preview mode. Rather than the whole track, only a handful of evenly spaced patches are decoded and run through the
+#  model - enough for a usable vector in a fraction of the time, to be replaced by the full one later on.
+
+PREVIEW_NUM_PATCHES = 16
+
+
+def count_patches(filepath, sr=16000, mel_hop=256, patch_size=128, hop_size=64) -> int:
+    """
+    Return how many patches a full extraction would produce for the file, from its duration alone.
+    """
+    num_samples = int(librosa.get_duration(path=filepath) * sr)
+    num_frames = 1 + num_samples // mel_hop
+    return max(0, (num_frames - patch_size) // hop_size + 1)
+
+
+def _preview_patches(
+    filepath,
+    num_patches,
+    total_patches=None,
+    sr=16000,
+    patch_size=128,
+    hop_size=64,
+    fft_size=512,
+    mel_hop=256,
+    margin_seconds=0.25) -> np.ndarray:
+    """
+    Return num_patches evenly spaced patches out of the ones _audio_to_mel_patches would produce (approximately - each
+    patch's audio is decoded and resampled on its own), decoding only the audio those patches cover.
+    :param total_patches: the file's count_patches, if already known.
+    """
+    frontend = get_frontend(sr=sr, fft_size=fft_size, mel_hop=mel_hop)
+    if total_patches is None:
+        total_patches = count_patches(filepath, sr=sr, mel_hop=mel_hop, patch_size=patch_size, hop_size=hop_size)
+    patch_indices = np.unique(np.linspace(0, total_patches - 1, num_patches).round().astype(int))
+    patch_samples = (patch_size - 1) * mel_hop + fft_size
+    # decode a bit around each patch, st. the resampler's edge effects fall outside of it
+    margin = int(margin_seconds * sr)
+
+    patches = []
+    for patch_index in patch_indices:
+        # first sample of the patch's first (centered) frame - negative for the very first patch
+        first_sample = patch_index * hop_size * mel_hop - fft_size // 2
+        load_from = max(0, first_sample - margin)
+        y, _ = librosa.load(filepath, sr=sr, mono=True, offset=load_from / sr,
+                            duration=(first_sample + patch_samples + margin - load_from) / sr)
+        segment = np.zeros(patch_samples, dtype=np.float32)
+        # the zeros left around the decoded audio stand in for the centered framing's padding at the track's ends
+        lead = first_sample - load_from
+        available = y[max(lead, 0):max(lead, 0) + patch_samples - max(-lead, 0)]
+        segment[max(-lead, 0):max(-lead, 0) + available.shape[0]] = available
+        patches.append(frontend.frames_to_log_mel(segment, patch_size))
+    return np.stack(patches, axis=0)
+
+
+def model_path() -> str:
+    return os.path.join(config.program_files_dir, MODEL_FILENAME)
+
+
+# bump whenever a change to the extraction changes the vectors it produces (e.g. which patches go into the mean), st.
+#  vectors cached by an earlier version get recomputed just like those of another model
+EXTRACTION_VERSION = 2
+
+_model_fingerprints = dict()
+
+
+def model_fingerprint() -> Optional[str]:
+    """
+    Return a hash identifying the contents of the installed model file plus the extraction version, or None if there is
+    no model file. Vectors computed by different models (or extraction versions) aren't comparable, so cached vectors
+    are tagged with this.
+    """
+    path = model_path()
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    if key not in _model_fingerprints:
+        _model_fingerprints[key] = file_content_hash(path)
+    return f"{_model_fingerprints[key]}-v{EXTRACTION_VERSION}"
+
+
+def extract_affect_vector(filepath: str, streaming: Optional[bool] = None,
+                          feature_cache: Optional[MelFeatureCache] = None,
+                          backend: Optional[InferenceBackend] = None,
+                          preview_patches: Optional[int] = None,
+                          total_patches: Optional[int] = None) -> np.ndarray:
     """
     Return the affect vector for the song found at the given filepath.
+    :param streaming: whether to decode and analyse the file block by block, in constant memory. By default this is
+     decided by the track's duration.
+    :param feature_cache: if passed, the file's log-mel spectrogram is read from it if present (skipping decoding and
+     the spectrogram computation entirely), and written to it otherwise.
+    :param backend: the inference backend to run the model with, by default a shared TensorflowBackend.
+    :param preview_patches: if passed, compute a quick preview vector from (at most) this many evenly spaced patches
+     rather than the full track. This ignores streaming and feature_cache. Tracks short enough to have no more patches
+     than this get a full extraction.
+    :param total_patches: the file's count_patches, if already known - saves probing its duration again for a preview.
     """
-    mel_patches = _audio_to_mel_patches(filepath)
-    tensor_file = os.path.join(config.program_files_dir, "discogs-effnet-bs64-1.pb")
-    preds = _run_model_on_patches(tensor_file, mel_patches)
-    v = preds.mean(axis=0)
+    content_hash = file_content_hash(filepath) if feature_cache is not None else None
+    if preview_patches is not None and total_patches is None:
+        total_patches = count_patches(filepath)
+
+    if preview_patches is not None and total_patches > preview_patches:
+        patch_batches = _batched_patches(_preview_patches(filepath, preview_patches, total_patches))
+    elif content_hash is not None and feature_cache.contains(content_hash):
+        patch_batches = _stream_patch_batches(feature_cache.iter_log_mel(content_hash))
+    else:
+        if streaming is None:
+            streaming = _should_stream(filepath)
+        if streaming:
+            log_mel_frames = _stream_log_mel_frames(_stream_audio_blocks(filepath))
+            if content_hash is not None:
+                log_mel_frames = feature_cache.write_through(content_hash, log_mel_frames)
+            patch_batches = _stream_patch_batches(log_mel_frames)
+        else:
+            log_mel = _audio_to_log_mel(filepath)
+            if content_hash is not None:
+                feature_cache.insert_log_mel(content_hash, log_mel)
+            patch_batches = _batched_patches(_log_mel_to_patches(log_mel))
+
+    v = _mean_prediction(patch_batches, backend if backend is not None else default_backend())
     v /= np.sqrt(np.sum(np.square(v)))
     return v
@@ -0,0 +1,84 @@
+import os
+from typing import Iterator
+
+import h5py
+import numpy as np
+
+import config
+from .persistent_cache import hdf5_file_lock
+
+
+class MelFeatureCache:
+    """
+    Maintains a HDF5 cache of log-mel spectrograms (the model's input features), keyed by a hash of the audio file's
+    contents. Spectrograms are stored as (num_frames, n_mels) float32 datasets, chunked along time and compressed, st.
+    they can be written and read back block by block. With these cached, re-analysing a song (e.g. after swapping the
+    model) only costs inference - no decoding, resampling or STFT.
+    """
+
+    # bump if the front end in affect_vector_extraction changes in a way that changes its output
+    group_name = "log_mel_v1"
+    chunk_frames = 1024
+    read_block_frames = 8192
+
+    def __init__(self):
+        self.path = os.path.join(config.data_dir, 'mel_feature_cache.h5py')
+        self._lock = hdf5_file_lock(self.path)
+        with self._lock, h5py.File(self.path, 'a') as f:
+            f.require_group(self.group_name)
+
+    def contains(self, content_hash: str) -> bool:
+        with self._lock, h5py.File(self.path, 'r') as f:
+            dataset = f[self.group_name].get(content_hash, None)
+            # datasets are only marked complete once fully written - anything else is an interrupted write
+            return dataset is not None and bool(dataset.attrs.get("complete", False))
+
+    def _create_dataset(self, f: h5py.File, content_hash: str, n_mels: int) -> h5py.Dataset:
+        group = f[self.group_name]
+        if content_hash in group:
+            del group[content_hash]
+        return group.create_dataset(content_hash, shape=(0, n_mels), maxshape=(None, n_mels), dtype='float32',
+                                    chunks=(self.chunk_frames, n_mels), compression='gzip', compression_opts=4,
+                                    shuffle=True)
+
+    def insert_log_mel(self, content_hash: str, log_mel: np.ndarray):
+        with self._lock, h5py.File(self.path, 'a') as f:
+            dataset = self._create_dataset(f, content_hash, log_mel.shape[1])
+            dataset.resize(log_mel.shape[0], axis=0)
+            dataset[:] = log_mel
+            dataset.attrs["complete"] = True
+
+    def write_through(self, content_hash: str, log_mel_blocks: Iterator[np.ndarray]) -> Iterator[np.ndarray]:
+        """
+        Pass through a stream of log-mel blocks, appending each to the cache as it goes by. The entry only becomes
+        visible once the stream is exhausted.
+        """
+        created = False
+        for block in log_mel_blocks:
+            with self._lock, h5py.File(self.path, 'a') as f:
+                if not created:
+                    dataset = self._create_dataset(f, content_hash, block.shape[1])
+                    created = True
+                else:
+                    dataset = f[self.group_name][content_hash]
+                num_frames = dataset.shape[0]
+                dataset.resize(num_frames + block.shape[0], axis=0)
+                dataset[num_frames:] = block
+            yield block
+        if created:
+            with self._lock, h5py.File(self.path, 'a') as f:
+                f[self.group_name][content_hash].attrs["complete"] = True
+
+    def iter_log_mel(self, content_hash: str) -> Iterator[np.ndarray]:
+        """
+        Yield the cached spectrogram in blocks of frames, without loading all of it at once.
+        """
+        start = 0
+        while True:
+            with self._lock, h5py.File(self.path, 'r') as f:
+                dataset = f[self.group_name][content_hash]
+                block = dataset[start:start + self.read_block_frames]
+            if not block.shape[0]:
+                return
+            yield block
+            start += block.shape[0]
@@ -0,0 +1,156 @@
+"""
+Inference backends for the affect model. A backend maps batches of mel patches to the model's embeddings - everything
+before (decoding, spectrograms, patching) and after (averaging, normalizing) lives in affect_vector_extraction.
+"""
+
+import threading
+from typing import Optional, Sequence, List
+
+import numpy as np
+
+
+BATCH_SIZE = 64
+INPUT_TENSOR_NAME = "serving_default_melspectrogram:0"
+OUTPUT_TENSOR_NAME = "PartitionedCall:1"
+
+
+class InferenceBackend:
+    """
+    Base class for something that can run the affect model. Backends are expected to be reusable across songs (i.e.
+    to load the model once) and safe to call from several threads.
+    """
+
+    # the model has a fixed batch size
+    batch_size = BATCH_SIZE
+
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        """
+        Map a batch of at most batch_size patches, shape (n, 128, 96), to their embeddings, shape (n, 1280).
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _pad_batch(self, batch: np.ndarray) -> np.ndarray:
+        # the last batch of a song gets padded up to the model's batch size - callers slice the padding back off
+        if batch.shape[0] < self.batch_size:
+            pad = np.zeros((self.batch_size - batch.shape[0],) + batch.shape[1:], dtype=np.float32)
+            batch = np.concatenate([batch, pad], axis=0)
+        return batch
+
+
+class TensorflowBackend(InferenceBackend):
+    """
+    Runs the discogs-effnet GraphDef in a tf.compat.v1 Session, which is created on first use and kept open.
+    :param pb_path: path to the frozen model graph.
+    :param intra_op_threads: threads a single op (e.g. a convolution) may use. None lets tf use every core - set this
+     (and usually inter_op_threads=1) when running several extraction workers on one machine, st. they don't
+     oversubscribe the cores.
+    :param inter_op_threads: threads used to run independent ops concurrently.
+    :param optimize_graph: whether to have grappler inline the model's function calls and apply its full set of
+     rewrites (constant folding, op fusion, pruning) to the graph before running it.
+    :param reduced_precision: run eligible ops in bfloat16 on CPUs that support it (oneDNN auto mixed precision). This
+     changes the output slightly - see compare_backends.
+    """
+
+    def __init__(self, pb_path: str, intra_op_threads: Optional[int] = None, inter_op_threads: Optional[int] = None,
+                 optimize_graph: bool = True, reduced_precision: bool = False):
+        self.pb_path = pb_path
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.optimize_graph = optimize_graph
+        self.reduced_precision = reduced_precision
+        self._session = None
+        self._input_tensor = None
+        self._output_tensor = None
+        self._load_lock = threading.Lock()
+
+    def _session_config(self):
+        import tensorflow as tf
+        from tensorflow.core.protobuf import rewriter_config_pb2
+
+        session_config = tf.compat.v1.ConfigProto()
+        if self.intra_op_threads is not None:
+            session_config.intra_op_parallelism_threads = self.intra_op_threads
+        if self.inter_op_threads is not None:
+            session_config.inter_op_parallelism_threads = self.inter_op_threads
+        # own thread pools, st. several backends in one process honour their own thread settings
+        session_config.use_per_session_threads = True
+
+        rewrite_options = session_config.graph_options.rewrite_options
+        if self.optimize_graph:
+            session_config.graph_options.optimizer_options.opt_level = tf.compat.v1.OptimizerOptions.L1
+            session_config.graph_options.optimizer_options.do_function_inlining = True
+            on = rewriter_config_pb2.RewriterConfig.ON
+            rewrite_options.function_optimization = on
+            rewrite_options.constant_folding = on
+            rewrite_options.arithmetic_optimization = on
+            rewrite_options.remapping = on
+            rewrite_options.dependency_optimization = on
+            rewrite_options.loop_optimization = on
+        if self.reduced_precision:
+            # the field was renamed from _mkl to _onednn_bfloat16 in tf 2.9
+            for field in ("auto_mixed_precision_onednn_bfloat16", "auto_mixed_precision_mkl"):
+                if hasattr(rewrite_options, field):
+                    setattr(rewrite_options, field, rewriter_config_pb2.RewriterConfig.ON)
+                    break
+        return session_config
+
+    def _load(self):
+        # ugly, but avoids losing 5s to tf startup on every execution
+        import tensorflow as tf
+
+        graph_def = tf.compat.v1.GraphDef()
+        with tf.io.gfile.GFile(self.pb_path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+
+        if self.optimize_graph:
+            # drop everything the output doesn't depend on (e.g. the classifier head's other outputs)
+            graph_def = tf.compat.v1.graph_util.extract_sub_graph(graph_def, [OUTPUT_TENSOR_NAME.split(":")[0]])
+
+        graph = tf.Graph()
+        with graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        self._input_tensor = graph.get_tensor_by_name(INPUT_TENSOR_NAME)
+        self._output_tensor = graph.get_tensor_by_name(OUTPUT_TENSOR_NAME)
+        self._session = tf.compat.v1.Session(graph=graph, config=self._session_config())
+
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        if self._session is None:
+            with self._load_lock:
+                if self._session is None:
+                    self._load()
+        num_in_batch = batch.shape[0]
+        out = self._session.run(self._output_tensor,
+                                feed_dict={self._input_tensor: self._pad_batch(batch.astype(np.float32))})
+        return out[:num_in_batch]
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+
+def compare_backends(reference: InferenceBackend, candidate: InferenceBackend,
+                     patch_sets: Sequence[np.ndarray]) -> List[float]:
+    """
+    Return, for each set of patches (i.e. each song), the cosine similarity between the mean embeddings produced by the
+    two backends. Used to validate lossy backend settings (e.g. reduced precision) against the reference.
+    """
+    similarities = []
+    for patches in patch_sets:
+        vectors = []
+        for backend in (reference, candidate):
+            preds = np.concatenate([backend.predict(patches[i:i + backend.batch_size])
+                                    for i in range(0, patches.shape[0], backend.batch_size)])
+            v = preds.mean(axis=0, dtype=np.float64)
+            vectors.append(v / np.linalg.norm(v))
+        similarities.append(float(np.dot(vectors[0], vectors[1])))
+    return similarities
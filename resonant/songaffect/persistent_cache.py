@@ -1,4 +1,6 @@
 import os
+import threading
+from typing import Callable, Dict, Iterable, Optional, Tuple, Set, List
 
 import h5py
 import numpy as np
@@ -7,35 +9,192 @@ from urllib.parse import quote, unquote
 import config
 
 
+QUALITY_FULL = "full"
+QUALITY_PREVIEW = "preview"
+
+
+_file_locks = dict()
+_compaction_locks = dict()
+_file_locks_lock = threading.Lock()
+
+
+def hdf5_file_lock(path: str) -> threading.RLock:
+    """
+    Return the process-wide lock for the HDF5 file at the passed path. HDF5 doesn't allow a file to be open for writing
+    more than once at a time, so all access to a file, from whichever object, goes through its lock.
+    """
+    path = os.path.abspath(path)
+    with _file_locks_lock:
+        if path not in _file_locks:
+            _file_locks[path] = threading.RLock()
+        return _file_locks[path]
+
+
+def _compaction_lock(path: str) -> threading.Lock:
+    """
+    Return the process-wide lock serializing compactions of the HDF5 file at the passed path. Held for a whole
+    compaction, unlike the file lock - concurrent compactions would share the temp file.
+    """
+    path = os.path.abspath(path)
+    with _file_locks_lock:
+        if path not in _compaction_locks:
+            _compaction_locks[path] = threading.Lock()
+        return _compaction_locks[path]
+
+
 class AffectVectorCache:
     """
-    Maintains a HDF5 cache of all computed affect vectors, keyed by the song's raw name.
+    Maintains a HDF5 cache of all computed affect vectors, keyed by the song's raw name. Each vector is tagged with the
+    fingerprint of the model that produced it, and vectors from any other model are treated as absent - as are untagged
+    ones, which predate tagging and thus the current extraction. Vectors are also tagged with their quality level -
+    preview vectors are only computed from part of the song.
     """
-    def __init__(self):
+    def __init__(self, model_fingerprint: Optional[str] = None):
         self.path = os.path.join(config.data_dir, 'affect_vector_cache.h5py')
-        with h5py.File(self.path, 'a') as f:
+        self.model_fingerprint = model_fingerprint
+        self._lock = hdf5_file_lock(self.path)
+        self._compaction_lock = _compaction_lock(self.path)
+        # keys written while a compaction is running, st. it can bring them over before swapping files
+        self._touched_during_compaction: Optional[Set[str]] = None
+        with self._lock, h5py.File(self.path, 'a') as f:
             f.require_group("affect")
 
     def _key(self, raw_name: str) -> str:
         return quote(raw_name, safe='')
 
-    def insert_vector(self, raw_name: str, vec: np.ndarray):
-        assert vec.shape == (1280,) and vec.dtype != np.float32
+    def _is_current(self, dataset: h5py.Dataset) -> bool:
+        return self.model_fingerprint is None or dataset.attrs.get("model", None) == self.model_fingerprint
 
-        with h5py.File(self.path, 'a') as f:
+    def insert_vector(self, raw_name: str, vec: np.ndarray, quality: str = QUALITY_FULL):
+        """
+        Insert a vector computed with the current model, replacing any (stale or lower quality) vector for the same
+        song.
+        """
+        assert vec.shape == (1280,) and vec.dtype == np.float32
+
+        with self._lock, h5py.File(self.path, 'a') as f:
             group = f.require_group("affect")
-            group.create_dataset(self._key(raw_name), data=vec, dtype='float32')
+            key = self._key(raw_name)
+            if key in group:
+                del group[key]
+            dataset = group.create_dataset(key, data=vec, dtype='float32')
+            if self.model_fingerprint is not None:
+                dataset.attrs["model"] = self.model_fingerprint
+            dataset.attrs["quality"] = quality
+            if self._touched_during_compaction is not None:
+                self._touched_during_compaction.add(key)
 
-    def get_vector(self, raw_name: str) -> np.ndarray | None:
-        with h5py.File(self.path, 'r') as f:
+    def get_vector_and_quality(self, raw_name: str) -> Tuple[np.ndarray, str] | None:
+        with self._lock, h5py.File(self.path, 'r') as f:
             group = f.get("affect")
             if group is None:
                 return None
             key = self._key(raw_name)
-            if key not in group:
+            if key not in group or not self._is_current(group[key]):
                 return None
-            return group[key][()]
+            dataset = group[key]
+            # vectors from before quality levels existed are all full
+            return dataset[()], dataset.attrs.get("quality", QUALITY_FULL)
+
+    def get_vector(self, raw_name: str) -> np.ndarray | None:
+        entry = self.get_vector_and_quality(raw_name)
+        return entry[0] if entry is not None else None
+
+    def get_vectors(self, raw_names: Iterable[str]) -> Dict[str, np.ndarray]:
+        """
+        Return the current vectors of those of the passed songs that have one, by raw name. Reads them all in one go,
+        rather than opening the file per song like get_vector.
+        """
+        with self._lock, h5py.File(self.path, 'r') as f:
+            group = f.get("affect")
+            if group is None:
+                return dict()
+            vectors = dict()
+            for raw_name in raw_names:
+                key = self._key(raw_name)
+                if key in group and self._is_current(group[key]):
+                    vectors[raw_name] = group[key][()]
+            return vectors
+
+    def get_preview_raw_names(self):
+        """
+        Return the raw names of all songs whose current vector is only a preview.
+        """
+        with self._lock, h5py.File(self.path, 'r') as f:
+            return [unquote(key) for key, dataset in f["affect"].items()
+                    if self._is_current(dataset) and dataset.attrs.get("quality", QUALITY_FULL) == QUALITY_PREVIEW]
 
     def vector_exists(self, raw_name: str) -> bool:
-        with h5py.File(self.path, 'r') as f:
-            return self._key(raw_name) in f.get("affect", {})
+        with self._lock, h5py.File(self.path, 'r') as f:
+            group = f.get("affect", {})
+            key = self._key(raw_name)
+            return key in group and self._is_current(group[key])
+
+    def get_current_raw_names(self) -> List[str]:
+        """
+        Return the raw names of all songs with a vector from the current model.
+        """
+        with self._lock, h5py.File(self.path, 'r') as f:
+            return [unquote(key) for key, dataset in f["affect"].items() if self._is_current(dataset)]
+
+    def _copy_current(self, src_group: h5py.Group, dst_group: h5py.Group, key: str):
+        if key in dst_group:
+            del dst_group[key]
+        if key in src_group and self._is_current(src_group[key]):
+            src_group.copy(src_group[key], dst_group, name=key)
+
+    def compact(self, get_live_raw_names: Callable[[], Iterable[str]], batch_size: int = 256) -> Tuple[int, int, int]:
+        """
+        Rewrite the cache file keeping only the current-model vectors of the live songs, dropping everything else
+        (HDF5 never gives back the space of deleted datasets, so deleting alone doesn't shrink the file).
+
+        This runs online: the live vectors are copied over to a new file a batch at a time, only holding the file lock
+        per batch, and vectors written in the meantime are brought over before the new file replaces the old one. A
+        compaction started while another is running waits for it. Returns the file size before and after, and the
+        number of vectors dropped.
+        :param get_live_raw_names: returns the raw names of the songs to keep. Called once writes are being tracked, st.
+         a song added (and analyzed) concurrently is either among them or has its vector brought over as written.
+        """
+        with self._compaction_lock:
+            return self._compact(get_live_raw_names, batch_size)
+
+    def _compact(self, get_live_raw_names: Callable[[], Iterable[str]], batch_size: int) -> Tuple[int, int, int]:
+        temp_path = self.path + ".compacting"
+        with self._lock:
+            self._touched_during_compaction = set()
+        try:
+            live_keys = {self._key(raw_name) for raw_name in get_live_raw_names()}
+            with self._lock, h5py.File(self.path, 'r') as f:
+                size_before = os.path.getsize(self.path)
+                num_before = len(f["affect"])
+                keys_to_copy = [key for key in f["affect"].keys() if key in live_keys]
+        except BaseException:
+            self._touched_during_compaction = None
+            raise
+
+        dst = h5py.File(temp_path, 'w')
+        try:
+            dst_group = dst.create_group("affect")
+            for i in range(0, len(keys_to_copy), batch_size):
+                with self._lock, h5py.File(self.path, 'r') as src:
+                    for key in keys_to_copy[i:i + batch_size]:
+                        self._copy_current(src["affect"], dst_group, key)
+
+            with self._lock:
+                with h5py.File(self.path, 'r') as src:
+                    dst_group.attrs.update(src["affect"].attrs)
+                    # anything written during compaction is live by definition
+                    for key in self._touched_during_compaction:
+                        self._copy_current(src["affect"], dst_group, key)
+                num_after = len(dst_group)
+                dst.close()
+                os.replace(temp_path, self.path)
+                size_after = os.path.getsize(self.path)
+        finally:
+            self._touched_during_compaction = None
+            if dst.id.valid:
+                dst.close()
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        return size_before, size_after, num_before - num_after
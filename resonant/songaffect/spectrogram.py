@@ -0,0 +1,119 @@
+from functools import lru_cache
+from typing import List, Sequence
+
+import numpy as np
+import librosa
+from scipy.signal import get_window
+
+
+class MelSpectrogramFrontend:
+    """
+    Computes the model's input features (Essentia-style log-compressed mel spectrograms) from decoded mono signals.
+
+    The Hann window and mel filterbank are built once per instance, everything runs in float32, and the power/mel/log
+    steps are done in place on preallocated buffers, a bounded number of frames at a time. Several signals can be
+    passed at once, in which case their frames share the same fft and filterbank calls.
+    """
+
+    # frames processed per fft/matmul call - keeps the temporaries of a chunk small enough to stay in cache
+    chunk_frames = 2048
+
+    def __init__(self, sr=16000, n_mels=96, fft_size=512, mel_hop=256, scale=10000.0, eps=1e-10):
+        self.sr = sr
+        self.n_mels = n_mels
+        self.fft_size = fft_size
+        self.mel_hop = mel_hop
+        self.scale = np.float32(scale)
+        self.offset = np.float32(1.0 + eps)
+
+        # Use a Hann window with no normalization (as in Essentia)
+        self.window = get_window("hann", fft_size, fftbins=True).astype(np.float32)
+
+        # Mel filter bank matching Essentia parameters, transposed st. it right-multiplies the (frames, bins) power
+        mel_basis = librosa.filters.mel(
+            sr=sr,
+            n_fft=fft_size,
+            n_mels=n_mels,
+            fmin=0.0,
+            fmax=sr / 2,
+            htk=False,      # Use Slaney-style Mel scale
+            norm=None       # Match Essentia's "unit_tri"
+        )
+        self.mel_basis_t = np.ascontiguousarray(mel_basis.T, dtype=np.float32)
+
+    def num_frames(self, num_samples: int) -> int:
+        """
+        Number of frames produced for a signal of the given length, with centered framing.
+        """
+        return 1 + num_samples // self.mel_hop
+
+    def pad(self, signal: np.ndarray) -> np.ndarray:
+        """
+        Zero-pad a signal for centered framing (as librosa.stft(center=True) does by default).
+        """
+        half = self.fft_size // 2
+        padded = np.zeros(signal.shape[0] + 2 * half, dtype=np.float32)
+        padded[half:half + signal.shape[0]] = signal
+        return padded
+
+    def frames_to_log_mel(self, padded_signal: np.ndarray, num_frames: int) -> np.ndarray:
+        """
+        Compute the log-mel spectrogram of the first num_frames frames of an already padded signal, as an array of
+        shape (num_frames, n_mels).
+        """
+        frames = np.lib.stride_tricks.sliding_window_view(padded_signal, self.fft_size)[::self.mel_hop]
+        return self._log_mel_of_frames(frames[:num_frames])
+
+    def _log_mel_of_frames(self, frames: np.ndarray) -> np.ndarray:
+        num_frames = frames.shape[0]
+        out = np.empty((num_frames, self.n_mels), dtype=np.float32)
+        num_bins = self.fft_size // 2 + 1
+        power = np.empty((min(num_frames, self.chunk_frames), num_bins), dtype=np.float32)
+        imag_sq = np.empty_like(power)
+
+        for start in range(0, num_frames, self.chunk_frames):
+            stop = min(start + self.chunk_frames, num_frames)
+            n = stop - start
+            spectrum = np.fft.rfft(frames[start:stop] * self.window, axis=1)
+            # |S|^2 without the sqrt/square round trip through np.abs
+            np.square(spectrum.real, out=power[:n])
+            np.square(spectrum.imag, out=imag_sq[:n])
+            power[:n] += imag_sq[:n]
+            mel = out[start:stop]
+            np.matmul(power[:n], self.mel_basis_t, out=mel)
+            # Essentia-style compression: log10(1 + scale * mel), with eps to avoid log(0)
+            mel *= self.scale
+            mel += self.offset
+            np.log10(mel, out=mel)
+
+        return out
+
+    def log_mel(self, signal: np.ndarray) -> np.ndarray:
+        """
+        Return the log-mel spectrogram of a whole signal, as an array of shape (num_frames, n_mels).
+        """
+        signal = np.asarray(signal, dtype=np.float32)
+        return self.frames_to_log_mel(self.pad(signal), self.num_frames(signal.shape[0]))
+
+    def log_mel_batch(self, signals: Sequence[np.ndarray]) -> List[np.ndarray]:
+        """
+        Return the log-mel spectrograms of several signals, computing all of their frames in one go.
+        """
+        frame_counts = []
+        frame_views = []
+        for signal in signals:
+            signal = np.asarray(signal, dtype=np.float32)
+            num_frames = self.num_frames(signal.shape[0])
+            frame_counts.append(num_frames)
+            frame_views.append(
+                np.lib.stride_tricks.sliding_window_view(self.pad(signal), self.fft_size)[::self.mel_hop][:num_frames])
+        log_mel = self._log_mel_of_frames(np.concatenate(frame_views))
+        return np.split(log_mel, np.cumsum(frame_counts)[:-1])
+
+
+@lru_cache(maxsize=None)
+def get_frontend(sr=16000, n_mels=96, fft_size=512, mel_hop=256, scale=10000.0, eps=1e-10) -> MelSpectrogramFrontend:
+    """
+    Return a shared front end for the passed parameters, st. windows and filterbanks are only ever built once.
+    """
+    return MelSpectrogramFrontend(sr=sr, n_mels=n_mels, fft_size=fft_size, mel_hop=mel_hop, scale=scale, eps=eps)
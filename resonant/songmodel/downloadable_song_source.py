@@ -5,6 +5,10 @@ from .downloadable_song import DownloadableSong
 
 class DownloadableSongSource:
 
+    # whether get_newest_songs really is ordered from most recent, i.e. whether an update can stop at the first song
+    #  that's already known
+    ordered_by_recency = True
+
     def get_newest_songs(self) -> Iterable[DownloadableSong]:
         """
         Returns an iterable of DownloadableSongs from the source represented by this instance, ordered from most recent.
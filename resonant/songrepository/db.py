@@ -1,8 +1,10 @@
 import os
 from random import randint
-from typing import Optional, List
-from sqlalchemy import create_engine, Column, String
+from typing import Optional, List, Iterable, Set, Dict
+from sqlalchemy import create_engine, event, Column, String, Integer, select, func, bindparam
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import declarative_base, Session
+from sqlalchemy.pool import QueuePool
 
 import config
 from songmodel import KnownSong
@@ -15,11 +17,73 @@ class KnownSongModel(Base):
     __tablename__ = 'known_songs'
 
     raw_name = Column(String, primary_key=True)
-    name = Column(String, nullable=True)
-    artist = Column(String, nullable=True)
+    name = Column(String, nullable=True, index=True)
+    artist = Column(String, nullable=True, index=True)
     filepath = Column(String, nullable=False)
 
 
+class SongIdModel(Base):
+    """
+    Compact integer ids for songs, used by the API's compact protocol. AUTOINCREMENT st. an id is never reused, and rows
+    are never deleted, so a song keeps its id even if it's removed and re-added.
+    """
+    __tablename__ = 'song_ids'
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    song_id = Column(Integer, primary_key=True)
+    raw_name = Column(String, nullable=False, unique=True)
+
+
+# sqlite tuning. WAL lets readers proceed while a writer (e.g. a source update) holds the write lock, and with WAL
+#  synchronous=NORMAL is still safe against corruption (only the very last commits may be lost on power failure)
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -16000,       # negative means KiB, so ~16MB of page cache per connection
+    "mmap_size": 256 * 2**20,
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000,       # ms a writer waits on another writer before raising 'database is locked'
+}
+POOL_SIZE = 8
+POOL_MAX_OVERFLOW = 8
+# sqlite caps the number of bound variables per statement (999 on older builds), so IN (...) lookups get chunked
+MAX_IN_CLAUSE_SIZE = 500
+
+
+def _set_sqlite_pragmas(dbapi_connection, _connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {pragma}={value}")
+    cursor.close()
+
+
+# hot lookups as Core statements - these are built once, and SQLAlchemy caches their compiled form across executions
+_songs_table = KnownSongModel.__table__
+_select_by_raw_name = select(_songs_table).where(_songs_table.c.raw_name == bindparam("raw_name"))
+_select_exists_by_raw_name = select(_songs_table.c.raw_name).where(_songs_table.c.raw_name == bindparam("raw_name"))
+_select_by_artist = select(_songs_table).where(_songs_table.c.artist == bindparam("artist"))
+_select_by_name = select(_songs_table).where(_songs_table.c.name == bindparam("name"))
+_select_all = select(_songs_table)
+_select_count = select(func.count()).select_from(_songs_table)
+_select_at_offset = select(_songs_table).offset(bindparam("offset")).limit(1)
+_select_existing_raw_names = select(_songs_table.c.raw_name).where(
+    _songs_table.c.raw_name.in_(bindparam("raw_names", expanding=True)))
+_insert_ignoring_duplicates = sqlite_insert(_songs_table).on_conflict_do_nothing(index_elements=["raw_name"])
+_ids_table = SongIdModel.__table__
+_insert_id_ignoring_duplicates = sqlite_insert(_ids_table).on_conflict_do_nothing(index_elements=["raw_name"])
+# assigns ids to songs that don't have one yet - songs from before ids existed, on first start
+_insert_missing_ids = sqlite_insert(_ids_table).from_select(
+    ["raw_name"],
+    select(_songs_table.c.raw_name).where(_songs_table.c.raw_name.not_in(select(_ids_table.c.raw_name)))
+)
+_select_song_ids = select(_ids_table.c.song_id, _ids_table.c.raw_name).join(
+    _songs_table, _songs_table.c.raw_name == _ids_table.c.raw_name)
+
+
+def _row_to_song(row) -> KnownSong:
+    return KnownSong(row.raw_name, row.name, row.artist, row.filepath)
+
+
 class SongDBInterface:
     """
     Maintains a sql db of KnownSong objects with SQLAlchemy.
@@ -28,52 +92,77 @@ class SongDBInterface:
     def __init__(self):
         db_path = os.path.join(config.data_dir, "known_songs.db")
         db_url = f'sqlite:///{db_path}'
-        self.engine = create_engine(db_url, echo=False, future=True)
+        # connections get shared across the threads fastapi runs handlers on, hence check_same_thread
+        self.engine = create_engine(db_url, echo=False, future=True,
+                                    poolclass=QueuePool, pool_size=POOL_SIZE, max_overflow=POOL_MAX_OVERFLOW,
+                                    connect_args={"check_same_thread": False})
+        event.listen(self.engine, "connect", _set_sqlite_pragmas)
         Base.metadata.create_all(self.engine)
-
-    def _to_model(self, song: KnownSong) -> KnownSongModel:
+        # create_all skips tables that already exist, so indexes added after a db was created need creating separately
+        for index in _songs_table.indexes:
+            index.create(self.engine, checkfirst=True)
+        with self.engine.begin() as conn:
+            conn.execute(_insert_missing_ids)
+
+    @staticmethod
+    def _to_row(song: KnownSong) -> dict:
         if song.raw_name is None:
             raise ValueError("raw_name cannot be None (it's the primary key)")
-        return KnownSongModel(
-            raw_name=song.raw_name,
-            name=song.name,
-            artist=song.artist,
-            filepath=song.filename
-        )
+        return {"raw_name": song.raw_name, "name": song.name, "artist": song.artist, "filepath": song.filename}
+
+    def _to_model(self, song: KnownSong) -> KnownSongModel:
+        return KnownSongModel(**self._to_row(song))
 
     def add_song(self, song: KnownSong):
         model = self._to_model(song)
         with Session(self.engine) as session:
             session.add(model)
+            session.execute(_insert_id_ignoring_duplicates, [{"raw_name": song.raw_name}])
             session.commit()
 
-    def add_songs(self, songs: List[KnownSong]):
-        models = [self._to_model(s) for s in songs]
-        with Session(self.engine) as session:
-            session.add_all(models)
-            session.commit()
+    def add_songs(self, songs: List[KnownSong]) -> int:
+        """
+        Insert the passed songs in a single executemany, skipping any whose raw_name is already present (rather than
+        failing the whole batch), so re-running an import is harmless. Returns the number of rows actually inserted.
+        """
+        rows = [self._to_row(s) for s in songs]
+        if not rows: return 0
+        with self.engine.begin() as conn:
+            result = conn.execute(_insert_ignoring_duplicates, rows)
+            conn.execute(_insert_id_ignoring_duplicates, [{"raw_name": row["raw_name"]} for row in rows])
+            return result.rowcount
+
+    def get_song_ids(self) -> Dict[str, int]:
+        """
+        Return the integer id of every song in the db, by raw name.
+        """
+        with self.engine.connect() as conn:
+            return {row.raw_name: row.song_id for row in conn.execute(_select_song_ids)}
 
     def get_random_song(self) -> Optional[KnownSong]:
-        with Session(self.engine) as session:
-            count = session.query(KnownSongModel).count()
+        with self.engine.connect() as conn:
+            count = conn.execute(_select_count).scalar_one()
             if count == 0: return None
             offset = randint(0, count - 1)
-            row = session.query(KnownSongModel).offset(offset).limit(1).one()
-            return KnownSong(row.raw_name, row.name, row.artist, row.filepath)
+            row = conn.execute(_select_at_offset, {"offset": offset}).one()
+            return _row_to_song(row)
 
     def get_song_by_raw_name(self, raw_name: str) -> Optional[KnownSong]:
-        with Session(self.engine) as session:
-            row = session.get(KnownSongModel, raw_name)
-            if row:
-                return KnownSong(row.raw_name, row.name, row.artist, row.filepath)
-            raw_names = session.query(KnownSongModel.raw_name).all()
-            return None
+        with self.engine.connect() as conn:
+            row = conn.execute(_select_by_raw_name, {"raw_name": raw_name}).first()
+            return _row_to_song(row) if row else None
 
+    def get_songs_by_artist(self, artist: str) -> List[KnownSong]:
+        with self.engine.connect() as conn:
+            return [_row_to_song(row) for row in conn.execute(_select_by_artist, {"artist": artist})]
+
+    def get_songs_by_name(self, name: str) -> List[KnownSong]:
+        with self.engine.connect() as conn:
+            return [_row_to_song(row) for row in conn.execute(_select_by_name, {"name": name})]
 
     def get_all_songs(self) -> List[KnownSong]:
-        with Session(self.engine) as session:
-            results = session.query(KnownSongModel).all()
-            return [KnownSong(r.raw_name, r.name, r.artist, r.filepath) for r in results]
+        with self.engine.connect() as conn:
+            return [_row_to_song(row) for row in conn.execute(_select_all)]
 
     def remove_song_by_raw_name(self, raw_name: str):
         with Session(self.engine) as session:
@@ -82,6 +171,18 @@ class SongDBInterface:
                 session.delete(song)
                 session.commit()
 
+    def get_existing_raw_names(self, raw_names: Iterable[str]) -> Set[str]:
+        """
+        Return the subset of the passed raw names that are already in the db, using one query per chunk of names.
+        """
+        raw_names = list(raw_names)
+        existing = set()
+        with self.engine.connect() as conn:
+            for i in range(0, len(raw_names), MAX_IN_CLAUSE_SIZE):
+                chunk = raw_names[i:i + MAX_IN_CLAUSE_SIZE]
+                existing.update(conn.execute(_select_existing_raw_names, {"raw_names": chunk}).scalars())
+        return existing
+
     def is_in_db(self, raw_name: str) -> bool:
-        with Session(self.engine) as session:
-            return session.get(KnownSongModel, raw_name) is not None
+        with self.engine.connect() as conn:
+            return conn.execute(_select_exists_by_raw_name, {"raw_name": raw_name}).first() is not None
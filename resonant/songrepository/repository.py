@@ -1,15 +1,32 @@
 import os
-from itertools import takewhile
-from typing import Iterable, List, Optional
+import threading
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
 import config
 from .db import SongDBInterface
-from songmodel import KnownSong, DownloadableSong
+from songmodel import KnownSong, DownloadableSong, DownloadableSongSource
+
+
+# how many candidate songs are pulled from a source before checking them against the db in one query
+INGEST_BATCH_SIZE = 200
+
+
+def batched(iterable: Iterable, size: int) -> Iterator[List]:
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
 
 
 class SongRepository:
     def __init__(self):
         self.db = SongDBInterface()
+        # bumped on every change to the set of known songs, st. anything derived from the library can be keyed on it
+        self.version = 0
+        self._song_ids: Optional[Tuple[int, Dict[str, int], Dict[int, str]]] = None
+        # filenames of songs downloaded into the music dir that aren't in the db yet
+        self._pending_filenames: Set[str] = set()
+        self._pending_lock = threading.Lock()
 
     def get_all_songs(self) -> List[KnownSong]:
         return self.db.get_all_songs()
@@ -17,19 +34,121 @@ class SongRepository:
     def get_random_song(self) -> Optional[KnownSong]:
         return self.db.get_random_song()
 
+    def update_from_source(self, source: DownloadableSongSource) -> None:
+        """
+        Ingest the songs of the passed source that aren't known yet.
+        """
+        if source.ordered_by_recency:
+            self.download_new_songs(source.get_newest_songs())
+        else:
+            self.import_songs(source.get_newest_songs())
+
     def download_new_songs(self, songs: Iterable[DownloadableSong]):
         """
         Given an iterable of DownloadableSongs, downloads and ingests them into the database until it finds one that
         is already present, at which point it stops.
         """
-        to_download = takewhile(lambda s: not self.db.is_in_db(s.raw_name), songs)
-        new_songs = []
-        for song in to_download:
-            filename = song.id_ + ".mp3"
-            filepath = os.path.join(config.music_dir, filename)
+        for batch in batched(songs, INGEST_BATCH_SIZE):
+            new_in_batch, reached_known = self.select_new_songs(batch, stop_at_known=True)
+            self.add_songs([self.download_song(song) for song in new_in_batch])
+            if reached_known:
+                return
+
+    def import_songs(self, songs: Iterable[DownloadableSong]) -> int:
+        """
+        Given an iterable of DownloadableSongs, downloads and ingests every one that isn't in the database yet. Unlike
+        download_new_songs this does not stop at the first known song, and since each batch is committed as it
+        completes, an interrupted import can just be re-run. Returns the number of songs added.
+        """
+        num_added = 0
+        for batch in batched(songs, INGEST_BATCH_SIZE):
+            to_download, _ = self.select_new_songs(batch, stop_at_known=False)
+            num_added += self.add_songs([self.download_song(song) for song in to_download])
+        return num_added
+
+    def select_new_songs(self, batch: List[DownloadableSong],
+                         stop_at_known: bool) -> Tuple[List[DownloadableSong], bool]:
+        """
+        Return the songs of the batch that aren't in the db yet, checked in one query, and with stop_at_known, whether
+        the batch reached a known song (i.e. there's nothing new past it).
+        :param stop_at_known: for sources listing their newest songs first - only take the songs before the first known
+         one. Otherwise, take every unknown song, once each (a source may list the same song more than once).
+        """
+        existing = self.db.get_existing_raw_names(s.raw_name for s in batch)
+        if stop_at_known:
+            new_songs = []
+            for song in batch:
+                if song.raw_name in existing: break
+                new_songs.append(song)
+            return new_songs, len(new_songs) < len(batch)
+        new_songs = list({s.raw_name: s for s in batch if s.raw_name not in existing}.values())
+        return new_songs, False
+
+    def download_song(self, song: DownloadableSong) -> KnownSong:
+        """
+        Download the song into the music dir, without adding it to the db. Its file counts as pending (see
+        get_pending_filenames) until the song is added.
+        """
+        filename = song.id_ + ".mp3"
+        filepath = os.path.join(config.music_dir, filename)
+        with self._pending_lock:
+            self._pending_filenames.add(filename)
+        try:
             song.download(filepath)
-            new_songs.append(KnownSong.from_downloadable_song(song, filename))
-        self.db.add_songs(new_songs)
+        except BaseException:
+            with self._pending_lock:
+                self._pending_filenames.discard(filename)
+            raise
+        return KnownSong.from_downloadable_song(song, filename)
+
+    def get_pending_filenames(self) -> Set[str]:
+        """
+        Return the filenames in the music dir that are being downloaded, or have been but aren't in the db yet.
+        """
+        with self._pending_lock:
+            return set(self._pending_filenames)
+
+    def add_songs(self, songs: List[KnownSong]) -> int:
+        """
+        Insert already-downloaded songs, ignoring any that are already known. Returns the number actually inserted.
+        """
+        if not songs: return 0
+        num_added = self.db.add_songs(songs)
+        if num_added:
+            self.version += 1
+        # only once they're in the db, st. a file is always either pending or known
+        with self._pending_lock:
+            self._pending_filenames.difference_update(song.filename for song in songs)
+        return num_added
+
+    def remove_song_by_raw_name(self, raw_name: str):
+        self.db.remove_song_by_raw_name(raw_name)
+        self.version += 1
+
+    def _get_song_id_maps(self) -> Tuple[Dict[str, int], Dict[int, str]]:
+        # ids never change, but songs come and go - reload the (small) maps whenever the library changed
+        cached = self._song_ids
+        if cached is None or cached[0] != self.version:
+            version = self.version
+            id_by_raw_name = self.db.get_song_ids()
+            cached = (version, id_by_raw_name, {song_id: raw_name for raw_name, song_id in id_by_raw_name.items()})
+            self._song_ids = cached
+        return cached[1], cached[2]
+
+    def get_song_ids(self) -> Dict[str, int]:
+        """
+        Return the stable integer id of every known song, by raw name.
+        """
+        return self._get_song_id_maps()[0]
+
+    def get_raw_name_by_id(self, song_id: int) -> Optional[str]:
+        return self._get_song_id_maps()[1].get(song_id, None)
 
     def get_by_raw_name(self, raw_name: str) -> KnownSong:
-        return self.db.get_song_by_raw_name(raw_name)
\ No newline at end of file
+        return self.db.get_song_by_raw_name(raw_name)
+
+    def get_by_artist(self, artist: str) -> List[KnownSong]:
+        return self.db.get_songs_by_artist(artist)
+
+    def get_by_name(self, name: str) -> List[KnownSong]:
+        return self.db.get_songs_by_name(name)
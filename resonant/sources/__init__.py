@@ -1 +1,2 @@
 from .youtube import YoutubeDownloadableSongSource
+from .local import LocalFolderSongSource
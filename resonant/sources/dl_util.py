@@ -1,9 +1,10 @@
 import subprocess
 import os
-from typing import Tuple, Optional
+import threading
+from typing import Tuple, Optional, Dict, List, Union
 
-import requests
 import re
+import requests
 from io import BytesIO
 from urllib.parse import urlparse, parse_qs
 
@@ -11,6 +12,32 @@ import imageio.v2 as imageio
 from yt_dlp import YoutubeDL
 
 import config
+from .http_client import shared_client
+
+
+# ffmpeg runs are cpu bound, so however many downloads run at once, only config.max_concurrent_transcodes of them
+#  transcode at a time. created on first use, st. the config can be set after importing this
+_transcode_slots: Optional[threading.BoundedSemaphore] = None
+_transcode_slots_lock = threading.Lock()
+
+
+def _get_transcode_slots() -> threading.BoundedSemaphore:
+    global _transcode_slots
+    with _transcode_slots_lock:
+        if _transcode_slots is None:
+            _transcode_slots = threading.BoundedSemaphore(config.max_concurrent_transcodes or os.cpu_count() or 2)
+        return _transcode_slots
+
+
+def _run_ffmpeg(args: List[str], input_data: Optional[bytes] = None) -> subprocess.CompletedProcess:
+    """
+    Run ffmpeg with the passed arguments, feeding it input_data on stdin (for "pipe:0" inputs) if passed.
+    """
+    with _get_transcode_slots():
+        result = subprocess.run([config.ffmpeg_path] + args, input=input_data, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+    result.stderr = result.stderr.decode(errors="replace")
+    return result
 
 
 def download_from_youtube(url: str, file_path: str):
@@ -18,14 +45,24 @@ def download_from_youtube(url: str, file_path: str):
         ydl.download(url)
 
 
+def download_audio_from_youtube(url: str, file_path_stem: str) -> Tuple[str, Dict]:
+    """
+    Downloads only the best audio stream of a youtube video (no video track), keeping whatever container/codec youtube
+    serves it in. Returns the path of the downloaded file (file_path_stem + the stream's extension) and yt-dlp's info
+    dict for the video, which includes the audio codec and a thumbnail url.
+    """
+    options = {"outtmpl": file_path_stem + ".%(ext)s", "format": "bestaudio/best", "quiet": True, "noprogress": True,
+               # yt-dlp's own retries, with exponential backoff, for dropped connections and throttled fragments
+               "retries": 10, "fragment_retries": 10, "extractor_retries": 3,
+               "retry_sleep_functions": {"http": lambda n: min(60, 2 ** n), "fragment": lambda n: min(60, 2 ** n)}}
+    with YoutubeDL(options) as ydl:
+        info = ydl.extract_info(url, download=True)
+        return ydl.prepare_filename(info), info
+
+
 def convert_mp4_to_mp3(origin_file_path: str, destination_file_path: str, remove_original=True):
     # ffmpeg conversion
-    subprocess.Popen(
-        [config.ffmpeg_path, "-i", origin_file_path, destination_file_path],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True
-    ).communicate()
+    _run_ffmpeg(["-i", origin_file_path, destination_file_path])
 
     if remove_original:
         os.remove(origin_file_path)
@@ -38,8 +75,7 @@ def convert_mp4_to_mp3_with_cover(origin_file_path: str, destination_file_path:
     Extracts audio from an mp4 file into an mp3 file. Takes in a path to an image file to insert into the mp3's
     metadata as cover. Optionally deletes the original mp4 and image file upon completion.
     """
-    subprocess.Popen([
-        config.ffmpeg_path,
+    _run_ffmpeg([
         "-i", origin_file_path,
         "-i", image_path,
         "-map", "0:a",
@@ -50,11 +86,7 @@ def convert_mp4_to_mp3_with_cover(origin_file_path: str, destination_file_path:
         "-metadata:s:v", "title=Album cover",
         "-metadata:s:v", "comment=Cover (front)",
         destination_file_path,
-        "-y"],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True
-    ).communicate()
+        "-y"])
 
     if remove_original:
         os.remove(origin_file_path)
@@ -62,13 +94,61 @@ def convert_mp4_to_mp3_with_cover(origin_file_path: str, destination_file_path:
         os.remove(image_path)
 
 
+# crops the cover to the largest centered square
+SQUARE_CROP_FILTER = "crop=w='min(iw,ih)':h='min(iw,ih)'"
+
+
+def mux_audio_with_cropped_cover(audio_source: str, cover_source: Union[str, bytes], destination_file_path: str,
+                                 audio_codec: Optional[str] = None):
+    """
+    Writes an mp3 with the audio of audio_source and, as its cover, cover_source cropped into a square - all in a
+    single ffmpeg invocation. Both sources can be local paths or urls, since ffmpeg reads either, and the cover can also
+    be passed as the image file's bytes. The audio is only re-encoded if it isn't mp3 already (audio_codec being the
+    source's codec name, if known).
+    """
+    copy_audio = audio_codec is not None and audio_codec.lower() in ("mp3", "mp3float")
+    result = _run_ffmpeg([
+        "-i", audio_source,
+        "-i", "pipe:0" if isinstance(cover_source, bytes) else cover_source,
+        "-map", "0:a:0",
+        "-map", "1:v:0",
+        "-c:a", "copy" if copy_audio else "libmp3lame",
+        "-filter:v", SQUARE_CROP_FILTER,
+        "-frames:v", "1",
+        "-c:v", "mjpeg",
+        "-id3v2_version", "3",
+        "-metadata:s:v", "title=Album cover",
+        "-metadata:s:v", "comment=Cover (front)",
+        destination_file_path,
+        "-y"],
+        input_data=cover_source if isinstance(cover_source, bytes) else None)
+    if result.returncode != 0:
+        if os.path.exists(destination_file_path):
+            os.remove(destination_file_path)
+        raise RuntimeError(f"ffmpeg failed muxing {audio_source}: {result.stderr[-500:]}")
+
+
+def fetch_image(url: str) -> Optional[bytes]:
+    """
+    Return the contents of the image at the url, or None if it can't be fetched.
+    """
+    try:
+        response = shared_client().get(url)
+    except requests.RequestException:
+        return None
+    return response.content if response.status_code == 200 and response.content else None
+
+
+def youtube_thumbnail_urls(video_id: str) -> List[str]:
+    return [f"https://i.ytimg.com/vi/{video_id}/{quality}.jpg" for quality in ['maxresdefault', 'hqdefault']]
+
+
 def download_cropped_youtube_thumbnail(video_id: str, output_file_path: str):
     """
     Given the id of a youtube video, extracts its thumbnail, crops it into a square, and saves it into the passed path.
     """
-    for quality in ['maxresdefault', 'hqdefault']:
-        url = f"https://i.ytimg.com/vi/{video_id}/{quality}.jpg"
-        response = requests.get(url)
+    for url in youtube_thumbnail_urls(video_id):
+        response = shared_client().get(url)
         if response.status_code != 200: continue
         img = imageio.imread(BytesIO(response.content))
         h, w, _ = img.shape
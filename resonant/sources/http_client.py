@@ -0,0 +1,157 @@
+"""
+Shared HTTP plumbing for song sources: one pooled keep-alive session (st. large syncs don't pay a TLS handshake per
+request), token bucket rate limiting, and retries with exponential backoff and jitter for the errors that mean "try
+again later" (connection problems, 429s, 5xxs).
+"""
+
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Callable, Optional, Tuple, Type, TypeVar
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+T = TypeVar("T")
+
+DEFAULT_TIMEOUT_SECONDS = (5.0, 30.0)  # connect, read
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    """
+    Allows rate_per_second operations per second on average, with bursts of up to burst operations. Thread-safe.
+    """
+
+    def __init__(self, rate_per_second: float, burst: int = 1):
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, waiting for one if there are none left.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate_per_second)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate_per_second
+            time.sleep(wait)
+
+
+def backoff_delay(attempt: int, base_delay: float, max_delay: float) -> float:
+    """
+    "Full jitter" exponential backoff: a random delay up to base_delay * 2^attempt, capped at max_delay.
+    """
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def retry_with_backoff(function: Callable[[], T], max_attempts: int = 5, base_delay: float = 1.0,
+                       max_delay: float = 60.0, retry_on: Tuple[Type[BaseException], ...] = (Exception,)) -> T:
+    """
+    Call function until it doesn't raise one of retry_on, up to max_attempts times, backing off between attempts.
+    The last attempt's exception is re-raised.
+    """
+    for attempt in range(max_attempts):
+        try:
+            return function()
+        except retry_on as e:
+            if attempt == max_attempts - 1:
+                raise
+            delay = getattr(e, "retry_after", None)
+            time.sleep(delay if delay is not None else backoff_delay(attempt, base_delay, max_delay))
+
+
+class RetryableHTTPError(requests.HTTPError):
+    """
+    A response with a status code worth retrying on, carrying the delay the server asked for (Retry-After), if any.
+    """
+
+    def __init__(self, response: requests.Response):
+        super().__init__(f"{response.status_code} for {response.url}", response=response)
+        self.retry_after = _parse_retry_after(response.headers.get("Retry-After"))
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class HttpClient:
+    """
+    A requests.Session with a connection pool sized for concurrent use, a default timeout, a rate limit over all of its
+    requests, and retries with backoff.
+    :param rate_per_second: average requests per second allowed (None for no limit), with bursts of up to burst.
+    :param pool_size: connections kept alive per host - should be at least the number of threads using the client.
+    """
+
+    def __init__(self, rate_per_second: Optional[float] = 10.0, burst: int = 10, pool_size: int = 16,
+                 max_attempts: int = 5, base_delay: float = 1.0, max_delay: float = 60.0,
+                 timeout: Tuple[float, float] = DEFAULT_TIMEOUT_SECONDS):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.rate_limiter = TokenBucket(rate_per_second, burst) if rate_per_second is not None else None
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+
+    def _request_once(self, method: str, url: str, **kwargs) -> requests.Response:
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        response = self.session.request(method, url, timeout=kwargs.pop("timeout", self.timeout), **kwargs)
+        if response.status_code in RETRY_STATUS_CODES:
+            response.close()
+            raise RetryableHTTPError(response)
+        return response
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Like requests.Session.request, retrying on connection errors and retryable status codes. Other error statuses
+        are returned as they are, as requests does.
+        """
+        return retry_with_backoff(
+            lambda: self._request_once(method, url, **kwargs),
+            max_attempts=self.max_attempts, base_delay=self.base_delay, max_delay=self.max_delay,
+            retry_on=(RetryableHTTPError, requests.ConnectionError, requests.Timeout)
+        )
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+_shared_client: Optional[HttpClient] = None
+_shared_client_lock = threading.Lock()
+
+
+def shared_client() -> HttpClient:
+    """
+    Return the HttpClient shared by all sources, creating it on first use.
+    """
+    global _shared_client
+    with _shared_client_lock:
+        if _shared_client is None:
+            _shared_client = HttpClient()
+        return _shared_client
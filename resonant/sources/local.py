@@ -0,0 +1,178 @@
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Iterable, Dict, List, Tuple, Optional
+
+import mutagen
+from mutagen.easyid3 import EasyID3
+
+import config
+from songmodel import DownloadableSongSource, DownloadableSong
+from util import deterministic_hash
+
+
+logger = logging.getLogger(__name__)
+
+# only files that can go into the music dir as they are - anything else would need transcoding
+AUDIO_EXTENSIONS = (".mp3",)
+# below this many files to read tags from, a process pool costs more to start than it saves
+PROCESS_POOL_MIN_FILES = 256
+MANIFEST_VERSION = 1
+
+
+class LocalDownloadableSong(DownloadableSong):
+    """
+    A song sitting in a local folder. "Downloading" it hard-links it into the music dir, or copies it where that's not
+    possible (e.g. across drives).
+    """
+
+    def __init__(self, source_path: str, raw_name: str, name: Optional[str], artist: Optional[str]):
+        super().__init__(raw_name, name, artist)
+        self.source_path = source_path
+
+    def download(self, file_path: str):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        try:
+            os.link(self.source_path, file_path)
+        except OSError:
+            shutil.copyfile(self.source_path, file_path)
+
+
+def _scan_directory(path: str) -> Tuple[List[Tuple[str, int, int]], List[str]]:
+    """
+    Return the audio files (path, size, mtime_ns) and the subdirectories directly inside a directory.
+    """
+    files = []
+    subdirectories = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(entry.path)
+                elif entry.name.lower().endswith(AUDIO_EXTENSIONS) and entry.is_file():
+                    stat = entry.stat()
+                    files.append((entry.path, stat.st_size, stat.st_mtime_ns))
+    except OSError as e:
+        logger.warning("Could not scan %s: %r", path, e)
+    return files, subdirectories
+
+
+def scan_tree(root: str, num_workers: int = 8) -> List[Tuple[str, int, int]]:
+    """
+    Return all audio files (path, size, mtime_ns) under root, scanning directories in parallel - directory listings
+    release the GIL, and on network drives or a cold cache they are mostly waiting.
+    """
+    files = []
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        pending = {pool.submit(_scan_directory, root)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                directory_files, subdirectories = future.result()
+                files.extend(directory_files)
+                pending.update(pool.submit(_scan_directory, subdirectory) for subdirectory in subdirectories)
+    return files
+
+
+def read_tags(path: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Return the (name, artist) tags of an audio file, None where missing or unreadable.
+    """
+    try:
+        tags = mutagen.File(path, easy=True).tags
+    except Exception:
+        tags = None
+    if tags is None:
+        # mutagen.File gives up on mp3s whose audio frames it can't make sense of, even if the id3 tag is fine
+        try:
+            tags = EasyID3(path)
+        except Exception:
+            return None, None
+    name = tags.get("title", [None])[0]
+    artist = tags.get("artist", [None])[0]
+    return name or None, artist or None
+
+
+class LocalFolderSongSource(DownloadableSongSource):
+    """
+    Song source for a folder of music files on disk (searched recursively). The tags read from each file are kept in a
+    manifest in the data dir alongside the file's size and mtime, st. re-scanning only has to read the tags of files
+    that are new or changed since the last scan - which songs of the folder are already in the db is left to the
+    repository, which checks that in batches.
+    """
+
+    ordered_by_recency = False
+
+    def __init__(self, folder: str, ui_name: Optional[str] = None, num_workers: int = 8):
+        self.folder = os.path.abspath(folder)
+        self.ui_name = ui_name if ui_name is not None else os.path.basename(self.folder)
+        self.num_workers = num_workers
+
+    def get_name(self):
+        return f"Local folder {self.ui_name}"
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(config.data_dir, f"local_{deterministic_hash(self.folder)[:32]}_manifest.json")
+
+    def _load_manifest(self) -> Dict[str, list]:
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return dict()
+        return manifest["files"] if manifest.get("version") == MANIFEST_VERSION else dict()
+
+    def _save_manifest(self, files: Dict[str, list]):
+        temp_path = self.manifest_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": MANIFEST_VERSION, "files": files}, f)
+        os.replace(temp_path, self.manifest_path)
+
+    def _read_all_tags(self, paths: List[str]) -> List[Tuple[Optional[str], Optional[str]]]:
+        # mutagen is pure python, so past a handful of files it's worth going around the GIL. the workers are spawned
+        #  rather than forked, since this runs inside the server, next to its threads and their locks
+        if len(paths) >= PROCESS_POOL_MIN_FILES:
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=self.num_workers, mp_context=context) as pool:
+                return list(pool.map(read_tags, paths, chunksize=64))
+        with ThreadPoolExecutor(max_workers=self.num_workers) as pool:
+            return list(pool.map(read_tags, paths))
+
+    def _raw_name(self, path: str, name: Optional[str], artist: Optional[str]) -> str:
+        if name is not None and artist is not None:
+            raw_name = f"{artist}- {name}"
+        else:
+            # untagged - fall back on the path within the folder, which is at least unique
+            raw_name = os.path.splitext(os.path.relpath(path, self.folder))[0].replace(os.sep, " - ")
+        # raw names end up in urls
+        return raw_name.replace("/", "")
+
+    def get_newest_songs(self) -> Iterable[DownloadableSong]:
+        """
+        Returns every song in the folder, in no particular order.
+        """
+        old_manifest = self._load_manifest()
+        manifest = dict()
+        to_read = []
+        for path, size, mtime_ns in scan_tree(self.folder, self.num_workers):
+            key = os.path.relpath(path, self.folder)
+            entry = old_manifest.get(key, None)
+            if entry is not None and entry[0] == size and entry[1] == mtime_ns:
+                manifest[key] = entry
+            else:
+                to_read.append((key, path, size, mtime_ns))
+
+        tags = self._read_all_tags([path for _, path, _, _ in to_read])
+        for (key, path, size, mtime_ns), (name, artist) in zip(to_read, tags):
+            manifest[key] = [size, mtime_ns, self._raw_name(path, name, artist), name, artist]
+
+        if to_read or len(manifest) != len(old_manifest):
+            self._save_manifest(manifest)
+
+        for key, (_, _, raw_name, name, artist) in manifest.items():
+            yield LocalDownloadableSong(os.path.join(self.folder, key), raw_name, name, artist)
@@ -10,10 +10,24 @@ import config
 from songmodel import DownloadableSongSource, DownloadableSong
 from util import deterministic_hash
 from .dl_util import download_cropped_youtube_thumbnail, download_from_youtube, convert_mp4_to_mp3_with_cover, \
-    extract_youtube_id, extract_artist_and_name_from_youtube_title
+    extract_youtube_id, extract_artist_and_name_from_youtube_title, download_audio_from_youtube, \
+    mux_audio_with_cropped_cover, youtube_thumbnail_urls, fetch_image
+from .http_client import TokenBucket, retry_with_backoff
+
+
+# youtube starts refusing downloads when hit too often - space them out, and back off a whole download when it fails
+DOWNLOAD_RATE_LIMITER = TokenBucket(rate_per_second=0.5, burst=4)
+DOWNLOAD_ATTEMPTS = 4
+# data api calls, which the client retries itself (with backoff) on 429s and 5xxs
+API_RATE_LIMITER = TokenBucket(rate_per_second=5, burst=10)
+API_NUM_RETRIES = 5
 
 
 class YoutubeDownloadableSong(DownloadableSong):
+    # fetch only the audio stream and build the mp3 + cover in one ffmpeg pass, rather than downloading the full video,
+    #  the thumbnail and cropping it separately and then transcoding
+    single_pass = True
+
     def __init__(self, video_name, video_url):
         artist, name = extract_artist_and_name_from_youtube_title(video_name)
         raw_name = video_name.replace("/","")
@@ -21,10 +35,47 @@ class YoutubeDownloadableSong(DownloadableSong):
         self.video_url = video_url
 
     def download(self, file_path: str):
+        retry_with_backoff(lambda: self._download_once(file_path), max_attempts=DOWNLOAD_ATTEMPTS, base_delay=5.0)
+
+    def _download_once(self, file_path: str):
 
         # useful for testing when clearing out the db
         # if os.path.exists(file_path): return
 
+        DOWNLOAD_RATE_LIMITER.acquire()
+        if self.single_pass:
+            self._download_single_pass(file_path)
+        else:
+            self._download_video_and_convert(file_path)
+
+        if not os.path.exists(file_path):
+            raise Exception("Youtube download failed. Probably some kind of rate limiting")
+
+    def _download_single_pass(self, file_path: str):
+        temp_filepath_stem = os.path.join(config.temp_dir, self.id_)
+        temp_audio_filepath = None
+        try:
+            temp_audio_filepath, info = download_audio_from_youtube(self.video_url, temp_filepath_stem)
+            # yt-dlp's thumbnail is the best one it found, the fixed urls are there in case it can't be fetched. the
+            #  cover goes through the shared (pooled) http client and is piped into ffmpeg
+            cover_urls = youtube_thumbnail_urls(extract_youtube_id(self.video_url))
+            if info.get("thumbnail"):
+                cover_urls.insert(0, info["thumbnail"])
+            error = RuntimeError(f"No thumbnail could be fetched for {self.video_url}")
+            for cover_url in cover_urls:
+                cover = fetch_image(cover_url)
+                if cover is None: continue
+                try:
+                    mux_audio_with_cropped_cover(temp_audio_filepath, cover, file_path, info.get("acodec"))
+                    return
+                except RuntimeError as e:
+                    error = e
+            raise error
+        finally:
+            if temp_audio_filepath is not None and os.path.exists(temp_audio_filepath):
+                os.remove(temp_audio_filepath)
+
+    def _download_video_and_convert(self, file_path: str):
         temp_filepath = os.path.join(config.temp_dir, self.id_) + ".mp4"
         temp_cover_filepath = os.path.join(config.temp_dir, self.id_) + "_thumb.jpg"
 
@@ -34,10 +85,6 @@ class YoutubeDownloadableSong(DownloadableSong):
         convert_mp4_to_mp3_with_cover(temp_filepath, file_path, temp_cover_filepath,
                                       remove_original=True, remove_thumb=True)
 
-        if not os.path.exists(file_path):
-            # todo
-            raise Exception("Youtube download failed. Probably some kind of rate limiting, fixable with aria2c?")
-
 
 class YoutubeDownloadableSongSource(DownloadableSongSource):
     """
@@ -49,6 +96,8 @@ class YoutubeDownloadableSongSource(DownloadableSongSource):
         self.user_ui_name = user_ui_name
         self.credentials_file = credentials_file
         self.playlist_name = playlist_name
+        # the api client, built on first use and kept, st. its connection (and the credentials' token) are reused
+        self._youtube = None
 
     @classmethod
     def liked_videos_playlist(cls, user_ui_name: str, credentials_file: str):
@@ -86,15 +135,25 @@ class YoutubeDownloadableSongSource(DownloadableSongSource):
                 pickle.dump(credentials, token)
             return credentials
 
+    def _client(self):
+        if self._youtube is None:
+            # the discovery document ships with googleapiclient, so building doesn't fetch anything
+            self._youtube = build('youtube', 'v3', credentials=self.get_credentials(), static_discovery=True)
+        return self._youtube
+
+    @staticmethod
+    def _execute(request) -> Dict:
+        API_RATE_LIMITER.acquire()
+        return request.execute(num_retries=API_NUM_RETRIES)
+
     def get_newest_songs(self) -> Iterable[DownloadableSong]:
-        credentials = self.get_credentials()
-        youtube = build('youtube', 'v3', credentials=credentials)
+        youtube = self._client()
 
         # get channel data
-        channel_response = youtube.channels().list(
+        channel_response = self._execute(youtube.channels().list(
             part="contentDetails",
             mine=True
-        ).execute()
+        ))
 
         # fish out playlist id for liked videos
         liked_videos_playlist_id = channel_response['items'][0]['contentDetails']['relatedPlaylists'][self.playlist_name]
@@ -107,12 +166,12 @@ class YoutubeDownloadableSongSource(DownloadableSongSource):
         nextPageToken = None
 
         while True:
-            response = youtube.playlistItems().list(
+            response = self._execute(youtube.playlistItems().list(
                 part='snippet,contentDetails',
                 playlistId=liked_videos_playlist_id,
                 maxResults=50,
                 pageToken=nextPageToken
-            ).execute()
+            ))
 
             playlist_items.extend(response['items'])
             nextPageToken = response.get('nextPageToken')
@@ -133,10 +192,10 @@ class YoutubeDownloadableSongSource(DownloadableSongSource):
 
         # get video data
         for chunk in chunked(video_ids, 50):
-            details_response = youtube.videos().list(
+            details_response = self._execute(youtube.videos().list(
                 part='snippet',
                 id=','.join(chunk)
-            ).execute()
+            ))
 
             for item in details_response['items']:
                 video_id = item['id']
@@ -0,0 +1,164 @@
+"""
+Updating from several song sources at once. Listing a source is mostly waiting on the network, so every source gets its
+own thread, while the actual downloads of all sources share one bounded pool (and the transcodes within them a global
+limit, see sources.dl_util), st. a sync of several sources takes about as long as its slowest source.
+"""
+
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Any
+
+from songmodel import DownloadableSongSource, DownloadableSong, KnownSong
+from songrepository import SongRepository
+from songrepository.repository import INGEST_BATCH_SIZE, batched
+
+
+# failed downloads whose errors are kept per source - the rest are only counted
+MAX_DOWNLOAD_ERRORS = 20
+
+
+class SyncProgress:
+    """
+    Combined progress of a sync, per source and in total. Safe to read while the sync is running.
+    """
+
+    COUNTERS = ("listed", "new", "downloaded", "shared", "failed")
+
+    def __init__(self, source_names: List[str]):
+        self.started_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.states = {name: "pending" for name in source_names}
+        self.errors: Dict[str, str] = dict()
+        self.download_errors: Dict[str, List[str]] = {name: [] for name in source_names}
+        self.counts = {name: {counter: 0 for counter in self.COUNTERS} for name in source_names}
+        self._lock = threading.Lock()
+
+    def add(self, source_name: str, counter: str, amount: int = 1):
+        with self._lock:
+            self.counts[source_name][counter] += amount
+
+    def add_download_error(self, source_name: str, raw_name: str, error: str):
+        with self._lock:
+            self.counts[source_name]["failed"] += 1
+            if len(self.download_errors[source_name]) < MAX_DOWNLOAD_ERRORS:
+                self.download_errors[source_name].append(f"{raw_name}: {error}")
+
+    def set_state(self, source_name: str, state: str, error: Optional[str] = None):
+        with self._lock:
+            self.states[source_name] = state
+            if error is not None:
+                self.errors[source_name] = error
+
+    @property
+    def done(self) -> bool:
+        return self.finished_at is not None
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "done": self.done,
+                "elapsed_seconds": (self.finished_at or time.time()) - self.started_at,
+                "total": {counter: sum(c[counter] for c in self.counts.values()) for counter in self.COUNTERS},
+                "sources": {name: dict(state=self.states[name], error=self.errors.get(name),
+                                       download_errors=list(self.download_errors[name]), **self.counts[name])
+                            for name in self.states},
+            }
+
+
+class SourceSync:
+    """
+    Runs updates from several sources concurrently into one SongRepository. A song listed by more than one source is
+    only downloaded once - whichever source gets to it first downloads it, the others wait for that download.
+    :param max_concurrent_downloads: downloads in flight at once, over all sources. How many ffmpeg runs they share is
+     configured globally, see config.set_max_concurrent_transcodes.
+    """
+
+    def __init__(self, song_repository: SongRepository, max_concurrent_downloads: int = 4):
+        self.song_repository = song_repository
+        self.max_concurrent_downloads = max_concurrent_downloads
+        self.progress: Optional[SyncProgress] = None
+        self._in_flight: Dict[str, Future] = dict()
+        self._in_flight_lock = threading.Lock()
+        self._run_lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self.progress is not None and not self.progress.done
+
+    def start(self, sources: List[DownloadableSongSource]) -> SyncProgress:
+        """
+        Start a sync in the background and return its progress. If one is running already, return its progress instead.
+        """
+        with self._run_lock:
+            if not self.running:
+                self.progress = SyncProgress([source.get_name() for source in sources])
+                threading.Thread(target=self._run, args=(sources, self.progress), name="source-sync",
+                                 daemon=True).start()
+            return self.progress
+
+    def run(self, sources: List[DownloadableSongSource]) -> SyncProgress:
+        """
+        Sync from the passed sources, returning once all of them are done.
+        """
+        with self._run_lock:
+            if self.running:
+                raise RuntimeError("A sync is already running")
+            self.progress = SyncProgress([source.get_name() for source in sources])
+        self._run(sources, self.progress)
+        return self.progress
+
+    def _run(self, sources: List[DownloadableSongSource], progress: SyncProgress):
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_concurrent_downloads,
+                                    thread_name_prefix="sync-download") as download_pool, \
+                    ThreadPoolExecutor(max_workers=max(1, len(sources)),
+                                       thread_name_prefix="sync-source") as source_pool:
+                for future in [source_pool.submit(self._sync_source, source, progress, download_pool)
+                               for source in sources]:
+                    future.result()
+        finally:
+            with self._in_flight_lock:
+                self._in_flight.clear()
+            progress.finished_at = time.time()
+
+    def _sync_source(self, source: DownloadableSongSource, progress: SyncProgress, download_pool: ThreadPoolExecutor):
+        name = source.get_name()
+        progress.set_state(name, "running")
+        try:
+            for batch in batched(source.get_newest_songs(), INGEST_BATCH_SIZE):
+                progress.add(name, "listed", len(batch))
+                new_in_batch, reached_known = self.song_repository.select_new_songs(
+                    batch, stop_at_known=source.ordered_by_recency)
+                progress.add(name, "new", len(new_in_batch))
+
+                futures = [self._download(song, name, progress, download_pool) for song in new_in_batch]
+                downloaded = []
+                for song, future in zip(new_in_batch, futures):
+                    try:
+                        downloaded.append(future.result())
+                    except Exception as e:
+                        progress.add_download_error(name, song.raw_name, repr(e))
+                # songs shared with another source may get added twice, which the db ignores
+                self.song_repository.add_songs(downloaded)
+                if reached_known: break
+        except Exception as e:
+            progress.set_state(name, "failed", repr(e))
+            return
+        progress.set_state(name, "done")
+
+    def _download(self, song: DownloadableSong, source_name: str, progress: SyncProgress,
+                  download_pool: ThreadPoolExecutor) -> Future:
+        with self._in_flight_lock:
+            future = self._in_flight.get(song.raw_name, None)
+            if future is not None:
+                progress.add(source_name, "shared")
+                return future
+            future = download_pool.submit(self._download_song, song, source_name, progress)
+            self._in_flight[song.raw_name] = future
+            return future
+
+    def _download_song(self, song: DownloadableSong, source_name: str, progress: SyncProgress) -> KnownSong:
+        known_song = self.song_repository.download_song(song)
+        progress.add(source_name, "downloaded")
+        return known_song
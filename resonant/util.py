@@ -7,3 +7,12 @@ def deterministic_hash(string: str) -> str:
     return m.hexdigest()
 
 
+def file_content_hash(filepath: str, chunk_size: int = 2**20) -> str:
+    """
+    Return a string identifier of fixed (32-char) length for the contents of the file at the passed path.
+    """
+    m = sha256()
+    with open(filepath, "rb") as f:
+        while chunk := f.read(chunk_size):
+            m.update(chunk)
+    return m.hexdigest()[:32]